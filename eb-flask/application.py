@@ -1,4 +1,4 @@
-from flask import Flask, request, render_template, redirect, url_for, make_response, send_from_directory, jsonify, session
+from flask import Flask, Response, request, render_template, redirect, url_for, make_response, send_from_directory, jsonify, session, stream_with_context
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField
 
@@ -7,7 +7,6 @@ from article_manager import TCArticleManager
 import account_manager
 
 import subprocess
-import json
 
 from random import randint
 
@@ -31,6 +30,29 @@ application.config['SECRET_KEY'] = "maomao is the best"
 
 article_manager = TCArticleManager()
 web_headers = {'Content-Type': 'text/html'}
+preference_actions = ('like', 'dislike', 'uncertain')
+
+def parse_date(date_str, date_format="%Y-%m-%d"):
+    '''
+    @return - datetime of date_str, None if it is not of date_format
+    '''
+    try:
+        return datetime.strptime(date_str, date_format)
+    except (TypeError, ValueError):
+        return None
+
+# number of template chunks buffered before a streamed page is flushed to the browser
+stream_buffer_size = 5
+
+def stream_template(template_name, **context):
+    '''
+    Render a template incrementally, sending each chunk as soon as it is rendered
+    '''
+    application.update_template_context(context)
+    template = application.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(stream_buffer_size)
+    return Response(stream_with_context(stream), 200, web_headers)
 
 # Home page
 @application.route('/', methods=['GET','POST'])
@@ -57,10 +79,13 @@ def display_techcrunch_articles(date, diff=None):
     if date.lower() == 'today':
         date = datetime.today().strftime("%Y-%m-%d")
         return redirect(url_for('display_techcrunch_articles', date=date, diff=diff))
-    
+
+    dateObj = parse_date(date)
+    if dateObj is None:
+        return make_response("date must be of format yyyy-mm-dd", 400)
+
     # handle the case where diff is set, redirect to the actual date
     if diff:
-        dateObj = datetime.strptime(date, "%Y-%m-%d")
         if diff.lower() == 'prev':
             dateObj -= timedelta(days=1)
         elif diff.lower() == 'next':
@@ -73,59 +98,186 @@ def display_techcrunch_articles(date, diff=None):
         date = dateObj.strftime("%Y-%m-%d")
         return redirect(url_for('display_techcrunch_articles', date=date, diff=None))
     
-    article_list = []
-
-    # handle the user like/dislike event
+    # handle the user like/dislike event, the page posts to /api/preference
+    # when javascript is enabled, this form post is the fallback
     if request.method == 'POST':
-        article_list = json.loads(request.form.get('article_list').replace("\'", "\""))
-        title = request.form.get('title').lower().strip()
-        action = request.form.get('action').lower().strip()
-        prev_label = request.form.get('label').lower().strip()
-        date = request.form.get('date')
-        
-        # validate required fields present
-        # action = like/dislike/uncertain
-        # uid = user id
-        if title and action and ('uid' in session):
-            uid = session['uid']
-            article = {'title': title, 'date': date, 'prev_label': prev_label}
-            print(article)
-            if action == 'like':
-                article_manager.record_liked_article(user_id=uid, article=article)
-            elif action == 'dislike':
-                article_manager.record_dislike_article(user_id=uid, article=article)
-            elif action == 'uncertain':
-                article_manager.record_uncertain_article(user_id=uid, article=article)
+        article_id = request.form.get('article_id')
+        action = (request.form.get('action') or '').lower().strip()
+        if article_id and action in preference_actions and ('uid' in session):
+            article_manager.record_preference_by_id(session['uid'], article_id, action, date)
+
+    # the sentiment rollup of the date doubles as a filter of its articles
+    sentiment_rollup = article_manager.get_sentiment_rollup(date)
+    sentiment = (request.args.get('sentiment') or '').upper()
+    if sentiment:
+        article_list = sentiment_rollup.get(sentiment, [])
     else:
         article_list = article_manager.retrieve_articles(date)
 
+    # articles of this date are still being crawled, the page polls until they are ready
+    crawl_status = None
+    if len(article_list) == 0 and not sentiment:
+        crawl_status = article_manager.get_crawl_status(date)
+
     # render extra info if article has been labeled by user
     # https://stackoverflow.com/questions/40963401/flask-dynamic-data-update-without-reload-page
     if 'uid' in session:
-        uid = session['uid']
-        user_likes = set([article['title'] for article in article_manager.get_user_likes(uid)])
-        user_dislikes = set([article['title'] for article in article_manager.get_user_dislikes(uid)])
-        user_uncertains = set([article['title'] for article in article_manager.get_user_uncertains(uid)])
-
-        for article in article_list:
-            article['label'] = ''
-            title = article['title'].strip().lower()
-            if title in user_likes:
-                article['label'] = 'like'
-            elif title in user_dislikes:
-                article['label'] = 'dislike'
-            elif title in user_uncertains:
-                article['label'] = 'uncertain'
+        article_manager.label_articles(session['uid'], article_list)
+        article_manager.rank_articles(session['uid'], article_list)
 
     return make_response(
         render_template(
             'daily_news_summary.html',
             dateStr=date,
             article_list=article_list,
+            crawl_status=crawl_status,
+            sentiment=sentiment,
+            sentiment_counts={label: len(articles) for label, articles in sentiment_rollup.items()},
             session=session
             ), 
         200, web_headers)
 
+# Articles of the monday to sunday week of a date, streamed one day at a time
+@application.route('/Techcrunch/week/<date>', methods=['GET'])
+def display_techcrunch_week(date):
+    if date.lower() == 'today':
+        date = datetime.today().strftime("%Y-%m-%d")
+    dateObj = parse_date(date)
+    if dateObj is None:
+        return make_response("date must be of format yyyy-mm-dd", 400)
+    startObj = dateObj - timedelta(days=dateObj.weekday())
+    endObj = startObj + timedelta(days=6)
+    return stream_template(
+        'digest_summary.html',
+        title="Week of {}".format(startObj.strftime("%Y-%m-%d")),
+        prev_url=url_for('display_techcrunch_week', date=(startObj - timedelta(days=7)).strftime("%Y-%m-%d")),
+        next_url=url_for('display_techcrunch_week', date=(startObj + timedelta(days=7)).strftime("%Y-%m-%d")),
+        days=article_manager.iter_articles_range(
+            startObj.strftime("%Y-%m-%d"), endObj.strftime("%Y-%m-%d"), session.get('uid')),
+        session=session)
+
+# Articles of a month, streamed one day at a time
+@application.route('/Techcrunch/month/<month>', methods=['GET'])
+def display_techcrunch_month(month):
+    startObj = parse_date(month, "%Y-%m")
+    if startObj is None:
+        return make_response("month must be of format yyyy-mm", 400)
+    nextObj = (startObj + timedelta(days=31)).replace(day=1)
+    prevObj = (startObj - timedelta(days=1)).replace(day=1)
+    # days after today have no articles yet
+    endObj = min(nextObj - timedelta(days=1), datetime.today())
+    days = iter(())
+    if startObj <= endObj:
+        days = article_manager.iter_articles_range(
+            startObj.strftime("%Y-%m-%d"), endObj.strftime("%Y-%m-%d"), session.get('uid'))
+    return stream_template(
+        'digest_summary.html',
+        title=startObj.strftime("%B %Y"),
+        prev_url=url_for('display_techcrunch_month', month=prevObj.strftime("%Y-%m")),
+        next_url=url_for('display_techcrunch_month', month=nextObj.strftime("%Y-%m")),
+        days=days,
+        session=session)
+
+# Record a like/dislike/uncertain label of the logged in user
+# request json: {'article_id': str, 'action': 'like' | 'dislike' | 'uncertain', 'date': optional yyyy-mm-dd}
+@application.route('/api/preference', methods=['POST'])
+def record_preference():
+    if 'uid' not in session:
+        return jsonify({'error': 'login required'}), 401
+    data = request.get_json(silent=True) or {}
+    article_id = data.get('article_id')
+    action = str(data.get('action') or '').lower().strip()
+    if not article_id or action not in preference_actions:
+        return jsonify({'error': 'article_id and action of {} required'.format(', '.join(preference_actions))}), 400
+
+    date = data.get('date')
+    if date and parse_date(date) is None:
+        return jsonify({'error': 'date must be of format yyyy-mm-dd'}), 400
+
+    article = article_manager.record_preference_by_id(session['uid'], article_id, action, date)
+    if article is None:
+        return jsonify({'error': 'article not found'}), 404
+    return jsonify({'article_id': article_id, 'label': action})
+
+# Article list of a date, cacheable by the browser and a CDN
+@application.route('/api/articles/<date>', methods=['GET'])
+def get_articles(date):
+    if parse_date(date) is None:
+        return jsonify({'error': 'date must be of format yyyy-mm-dd'}), 400
+    article_list = article_manager.retrieve_articles(date)
+    if len(article_list) == 0:
+        # still being crawled, nothing to cache yet
+        response = jsonify({'date': date, 'articles': [], 'crawl_status': article_manager.get_crawl_status(date)})
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    article_list.sort(key=lambda article: article['title'])
+    response = jsonify({'date': date, 'articles': article_list})
+    # hash of the body, the analyzer adds entities and sentiment to the articles after the crawl
+    response.add_etag()
+    # past dates do not change, recent dates may still get new articles
+    response.cache_control.public = True
+    response.cache_control.max_age = article_manager.article_cache.get_ttl(date.replace("-", "/"))
+    return response.make_conditional(request)
+
+# Labels of the logged in user, revalidated with the snapshot etag on every use
+@application.route('/api/users/<uid>/preferences', methods=['GET'])
+def get_user_preferences(uid):
+    if session.get('uid') != uid:
+        return jsonify({'error': 'forbidden'}), 403
+    snapshot = article_manager.get_user_pref_snapshot(uid)
+    response = jsonify({pref: snapshot.get_articles(pref) for pref in snapshot.preference_types})
+    response.set_etag(snapshot.get_etag())
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+# Articles mentioning an entity, newest first
+@application.route('/Entity/<name>', methods=['GET'])
+def display_entity_articles(name):
+    return make_response(
+        render_template(
+            'entity_articles.html',
+            entity=name,
+            article_list=article_manager.get_entity_articles(name, session.get('uid')),
+            session=session
+            ),
+        200, web_headers)
+
+# Full text search of the articles
+@application.route('/search', methods=['GET'])
+def search_articles():
+    query = request.args.get('q', '').strip()
+    article_list = article_manager.search_articles(query, session.get('uid')) if query else []
+    return make_response(
+        render_template(
+            'search_results.html',
+            query=query,
+            article_list=article_list,
+            session=session
+            ),
+        200, web_headers)
+
+# Crawl status of a date, polled by the article page while the date is being fetched
+@application.route('/api/crawl/<date>', methods=['GET'])
+def get_crawl_status(date):
+    if parse_date(date) is None:
+        return jsonify({'error': 'date must be of format yyyy-mm-dd'}), 400
+    return jsonify(article_manager.get_crawl_status(date))
+
+# Recommended articles of the user, one lookup of the precomputed feed
+@application.route('/User/<uid>/ForYou', methods=['GET'])
+def display_user_recommendations(uid):
+    return make_response(
+        render_template(
+            'for_you.html',
+            uid=uid,
+            article_list=article_manager.get_recommendations(uid),
+            session=session
+            ),
+        200, web_headers)
+
 # User preference page
 @application.route('/User/<uid>/<prefType>', methods=['GET','POST'])
 def display_user_likes(uid, prefType):
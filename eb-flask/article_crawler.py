@@ -1,30 +1,51 @@
 # 1. Invoke lambda function daily-article-dev-scraper
-# 2. poll from SQS to get the fetch complete notification
+# 2. poll from SQS to get the fetch complete notification, the queue url is passed in the
+#    invoke payload and the scraper sends {'date', 'request_timestamp', 'status', 'article_count'}
+#    to it once the crawl is over, see send_complete_message in lambda_tc_article_crawler/handler.py
 # 3. get articles from dynamodb, which are populated by lambda func in step 1
+#
+# Web requests never wait on the steps above, CrawlScheduler runs them on a
+# small background worker pool and concurrent requests for the same date
+# share a single crawl job.
 
 import boto3
 import json
+from botocore.config import Config
 import time
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from aws_gateway import AWS_Article_DB
+from cache_manager import TTLCache
 
 sqs_arn = 'arn:aws:sqs:us-east-1:672834257724:daily-article-scrapper-complete-message'
+sqs_queue_name = 'daily-article-scrapper-complete-message'
+sqs_queue_owner = '672834257724'
 lambda_func_name = 'daily-article-dev-scraper'
-lambda_client = boto3.client('lambda', region_name='us-east-1')
+sqs_client = boto3.client('sqs', region_name='us-east-1')
 article_db = AWS_Article_DB()
 
+# crawl scheduler settings
+max_concurrent_crawls = 4
+crawl_timeout_sec = 5 * 60
+sqs_wait_time_sec = 20
+# messages older than a crawl can wait for have no waiter left and are deleted
+stale_message_sec = crawl_timeout_sec + 60
+finished_crawl_ttl = 10 * 60
+failed_crawl_ttl = 60
+
+# one shared client for every invoke, its connection pool is sized for the crawl workers
+# and the read timeout covers a synchronous RequestResponse crawl
+lambda_client = boto3.client('lambda', region_name='us-east-1', config=Config(
+    max_pool_connections=max_concurrent_crawls * 2,
+    read_timeout=15 * 60,
+    retries={'max_attempts': 2}))
+
 current_milli_time = lambda: int(round(time.time() * 1000))
 
 def fetch_articles_with_lambda(date_str):
     start_time = current_milli_time()
 
-    update_response = lambda_client.update_function_configuration(
-        FunctionName='daily-article-dev-scraper',
-        Environment={
-            'Variables': {
-                'date': date_str
-            }
-        })
-
     invoke_response = lambda_client.invoke(
             FunctionName=lambda_func_name,
             InvocationType='RequestResponse',
@@ -42,7 +63,7 @@ def fetch_articles_with_lambda(date_str):
     response_json = json.loads(invoke_response['Payload'].read().decode("utf-8"))
     print(response_json)
 
-    if invoke_response['StatusCode'] is 200:
+    if invoke_response['StatusCode'] == 200:
         print("successfully fetched tc articles using lambda {}".format(lambda_func_name))
         print("operation took {} ms".format(end_time - start_time))
         # now get articles from dynamodb
@@ -52,7 +73,158 @@ def fetch_articles_with_lambda(date_str):
             print("{}: {}".format(str(idx+1), article['title']))
 
     return article_list
-    
+
+
+def crawl_articles_with_lambda(date_str, timeout=crawl_timeout_sec):
+    '''
+    Start the scraper lambda without waiting on it,
+    then wait for its completion message on SQS and read the articles from dynamodb
+    @param date_str - date string of format yyyy-mm-dd
+    @param timeout - max seconds to wait for the completion message
+    @return - list of article dict
+    '''
+    start_time = current_milli_time()
+    queue_url = get_queue_url()
+
+    lambda_client.invoke(
+            FunctionName=lambda_func_name,
+            InvocationType='Event',
+            LogType='None',
+            Payload=json.dumps({
+                'date': date_str,
+                'request_timestamp': str(start_time),
+                'test': True,
+                'complete_queue_url': queue_url
+            }))
+
+    message = wait_for_complete_message(queue_url, date_str, timeout)
+    if message is None:
+        print("no complete message for date {} after {} seconds, reading dynamodb anyway".format(date_str, timeout))
+    elif message.get('status') == 'failed':
+        raise RuntimeError("scraper failed to crawl date {}".format(date_str))
+
+    article_list = article_db.get_articles_by_date(date_str.replace("-", "/"))
+    print("crawl for {} took {} ms and got {} articles".format(
+        date_str, current_milli_time() - start_time, len(article_list)))
+    return article_list
+
+
+_queue_url = None
+
+def get_queue_url():
+    global _queue_url
+    if _queue_url is None:
+        _queue_url = sqs_client.get_queue_url(
+            QueueName=sqs_queue_name, QueueOwnerAWSAccountId=sqs_queue_owner)['QueueUrl']
+    return _queue_url
+
+
+def wait_for_complete_message(queue_url, date_str, timeout):
+    '''
+    Long poll the scraper complete queue until the message of date_str arrives.
+    Messages for other dates are made visible again right away for the other waiters,
+    unless they are older than any waiter or unreadable, then they are deleted.
+    @return - the message dict, or None if it did not arrive before timeout
+    '''
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        wait_time = int(max(1, min(sqs_wait_time_sec, deadline - time.time())))
+        response = sqs_client.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=wait_time,
+            AttributeNames=['SentTimestamp'])
+
+        for message in response.get('Messages', []):
+            try:
+                body = json.loads(message['Body'])
+            except ValueError:
+                body = None
+            if isinstance(body, dict) and body.get('date') == date_str:
+                sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+                return body
+            sent_time = int(message.get('Attributes', {}).get('SentTimestamp', 0)) / 1000
+            if not isinstance(body, dict) or time.time() - sent_time > stale_message_sec:
+                sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+                continue
+            sqs_client.change_message_visibility(
+                QueueUrl=queue_url,
+                ReceiptHandle=message['ReceiptHandle'],
+                VisibilityTimeout=0)
+    return None
+
+
+class CrawlScheduler:
+    '''
+    Runs crawls for missing dates in the background.
+    At most max_workers crawls run at once, concurrent requests for the same date
+    share the in-flight job, and finished jobs are remembered for a while so that
+    a date without any article is not crawled again on every page load.
+    '''
+    def __init__(self, max_workers=max_concurrent_crawls, crawl_func=crawl_articles_with_lambda, on_complete=None):
+        '''
+        @param max_workers - max number of crawls running at the same time
+        @param crawl_func - function(date_str) returning the crawled article list
+        @param on_complete - optional callback(date_str, article_list) called after a successful crawl
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.crawl_func = crawl_func
+        self.on_complete = on_complete
+        self.in_flight = {}
+        self.finished = TTLCache(max_entries=256, ttl=finished_crawl_ttl)
+        self._lock = threading.Lock()
+
+    def request_crawl(self, date_str):
+        '''
+        Schedule a crawl for date_str unless one is running or has recently finished,
+        malformed and future dates are never crawled
+        @param date_str - date string of format yyyy-mm-dd
+        @return - crawl status dict, see get_status
+        '''
+        try:
+            date_obj = datetime.strptime(date_str, "%Y-%m-%d")
+        except (TypeError, ValueError):
+            print("[error] refusing to crawl malformed date {}".format(date_str))
+            return {'date': date_str, 'status': 'none', 'article_count': 0}
+        if date_obj > datetime.today():
+            print("refusing to crawl future date {}".format(date_str))
+            return {'date': date_str, 'status': 'none', 'article_count': 0}
+
+        with self._lock:
+            if date_str not in self.in_flight and date_str not in self.finished:
+                print("scheduling crawl for date {}".format(date_str))
+                self.in_flight[date_str] = self.executor.submit(self._run_crawl, date_str)
+        return self.get_status(date_str)
+
+    def get_status(self, date_str):
+        '''
+        @return - {'date': str, 'status': 'pending' | 'done' | 'failed' | 'none', 'article_count': int}
+        '''
+        with self._lock:
+            if date_str in self.in_flight:
+                return {'date': date_str, 'status': 'pending', 'article_count': 0}
+            result = self.finished.get(date_str)
+        if result is None:
+            return {'date': date_str, 'status': 'none', 'article_count': 0}
+        return dict(result, date=date_str)
+
+    def _run_crawl(self, date_str):
+        result = {'status': 'failed', 'article_count': 0}
+        try:
+            article_list = self.crawl_func(date_str)
+            result = {'status': 'done', 'article_count': len(article_list)}
+            if self.on_complete is not None:
+                self.on_complete(date_str, article_list)
+        except Exception as e:
+            print("[error] crawl for date {} failed".format(date_str))
+            print(e)
+        finally:
+            with self._lock:
+                ttl = finished_crawl_ttl if result['status'] == 'done' else failed_crawl_ttl
+                self.finished.set(date_str, result, ttl=ttl)
+                self.in_flight.pop(date_str, None)
+
 
 if __name__ == "__main__":
     fetch_articles_with_lambda('2019-09-08')
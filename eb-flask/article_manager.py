@@ -3,10 +3,33 @@ import pymongo
 import subprocess
 import json
 import hashlib
-from functools import lru_cache
-from aws_gateway import AWS_Pref_DB, AWS_Article_DB
+from storage import create_storage
+from cache_manager import TTLCache, UserPrefSnapshot, ArticleCache
+from search_index import SearchIndex
+from ranking import FeatureMatrix, UserProfile
+import numpy as np
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import article_crawler
 
+# per-user preference snapshot cache settings
+user_pref_cache_size = 256
+user_pref_cache_ttl = 15 * 60
+
+# per-date article cache settings
+article_cache_size = 64
+article_cache_max_bytes = 32 * 1024 * 1024
+article_cache_history_ttl = 24 * 60 * 60
+article_cache_recent_ttl = 5 * 60
+
+# feature matrices of ranked article lists, keyed by their article ids and entities
+feature_cache_size = 64
+
+# per-date sentiment rollup and per-entity article list cache settings
+analysis_cache_size = 256
+# a date not analyzed yet is read again soon, the analyzer runs right after the crawl
+empty_rollup_ttl = 30
+
 def getTitleHash(title):
   '''
   Get the SHA hashed string for the given article title,
@@ -16,39 +39,231 @@ def getTitleHash(title):
   '''
   return hashlib.sha256(title.encode().strip().lower()).hexdigest()
 
+def getArticleListHash(article_list):
+  '''
+  Get the SHA hashed string of the article ids of a list, independent of the list order
+  @param article_list - list of article dict
+  @return SHA hashed string
+  '''
+  return hashlib.sha256(",".join(sorted(article['article_id'] for article in article_list)).encode()).hexdigest()
+
 class TCArticleManager:
-  def __init__(self):
-    self.article_db = AWS_Article_DB()
-    self.user_pref_db = AWS_Pref_DB()
+  def __init__(self, article_db=None, user_pref_db=None):
+    '''
+    @param article_db - storage.Article_DB, defaults to the configured storage backend
+    @param user_pref_db - storage.Pref_DB, defaults to the configured storage backend
+    '''
+    if article_db is None or user_pref_db is None:
+      default_article_db, default_user_pref_db = create_storage()
+      article_db = article_db or default_article_db
+      user_pref_db = user_pref_db or default_user_pref_db
+    self.article_db = article_db
+    self.user_pref_db = user_pref_db
+    self.user_pref_cache = TTLCache(max_entries=user_pref_cache_size, ttl=user_pref_cache_ttl)
+    self.article_cache = ArticleCache(
+      max_entries=article_cache_size,
+      max_bytes=article_cache_max_bytes,
+      history_ttl=article_cache_history_ttl,
+      recent_ttl=article_cache_recent_ttl)
+    self.analysis_cache = TTLCache(max_entries=analysis_cache_size, ttl=article_cache_recent_ttl)
+    self.feature_cache = TTLCache(max_entries=feature_cache_size, ttl=article_cache_history_ttl)
+    if self.article_db.has_scraper:
+      self.crawl_scheduler = article_crawler.CrawlScheduler(on_complete=self.on_crawl_complete)
+      self.search_index = SearchIndex()
+    else:
+      # no scraper lambda behind the store, a crawl only re-reads the store
+      self.crawl_scheduler = article_crawler.CrawlScheduler(
+        crawl_func=lambda date_str: self.article_db.get_articles_by_date(date_str.replace("-", "/")),
+        on_complete=self.on_crawl_complete)
+      # and there are no article bodies, only titles are searchable
+      self.search_index = SearchIndex(text_loader=lambda date, article_ids: {})
+    # days read from the database but missing from the search index are indexed in the background,
+    # one at a time as loading their article bodies is slow
+    self.index_executor = ThreadPoolExecutor(max_workers=1)
+    self.indexing_days = set()
+    self._index_lock = threading.Lock()
     # self.article_crawler = TCArticleCrawler()
     return
 
-  # https://docs.python.org/3/library/functools.html
-  # https://www.programcreek.com/python/example/29697/functools.lru_cache
-  @lru_cache(maxsize=15)
   def retrieve_articles(self, date, full_content=False):
     '''
     @function - retrieve articles published on date, 
-                load from database if entry exist, 
+                served from the article cache if present,
+                otherwise load from database if entry exist, 
                 otherwise get from web crawler and back fill into datebase
     @param date - a datetime string for when the articles are published
-    @return - a list of article dict
+    @return - a list of article dict, owned by the caller
     '''
     date = date.replace("-", "/")
+    article_list = self.article_cache.get(date, full_content)
+    if article_list is not None:
+      return article_list
+
     print("getting article by date: " + date)
     article_list = self.article_db.get_articles_by_date(date)
 
     if article_list is None or len(article_list) == 0:
-      # no entry in dynamodb, crawl from tc website instead
-      article_list = article_crawler.fetch_articles_with_lambda(date.replace("/", "-"))
-      for article in article_list:
-        article['article_id'] = getTitleHash(article['title'])
+      # no entry in dynamodb, crawl from tc website in the background,
+      # callers check get_crawl_status to know when the articles are ready
+      self.crawl_scheduler.request_crawl(date.replace("/", "-"))
+      return []
 
     if not full_content:
       for article in article_list:
         if 'text' in article:
           article.pop("text", None)
 
+    self.article_cache.put(date, article_list, full_content)
+    # days stored by the scheduled scraper never went through on_crawl_complete
+    self.request_index(date, article_list)
+    return article_list
+
+
+  def iter_articles_range(self, start, end, user_id=None):
+    '''
+    @function - retrieve articles published between start and end inclusive, one date at a time,
+                dates missing from the article cache are read from database concurrently and back filled,
+                dates without articles are not crawled
+    @param start - date string of format yyyy-mm-dd
+    @param end - date string of format yyyy-mm-dd
+    @param user_id - if set, article['label'] is set to the user preference of each article
+    @return - generator of (date of format yyyy/mm/dd, list of article dict) ordered by date
+    '''
+    start_date = datetime.strptime(start.replace("/", "-"), "%Y-%m-%d")
+    end_date = datetime.strptime(end.replace("/", "-"), "%Y-%m-%d")
+    dates = [(start_date + timedelta(days=day)).strftime("%Y/%m/%d") for day in range((end_date - start_date).days + 1)]
+
+    snapshot = self.get_user_pref_snapshot(user_id) if user_id else None
+    articles_by_date, missing_dates = self.article_cache.get_many(dates)
+    if len(missing_dates) > 0:
+      print("getting articles of {} dates from {} to {}".format(len(missing_dates), missing_dates[0], missing_dates[-1]))
+      missing_articles = self.article_db.iter_articles_by_dates(missing_dates)
+    else:
+      missing_articles = iter(())
+
+    for date in dates:
+      article_list = articles_by_date.get(date)
+      if article_list is None:
+        # missing dates come in order from the concurrent reads
+        _, article_list = next(missing_articles)
+        for article in article_list:
+          article.pop("text", None)
+        self.article_cache.put(date, article_list)
+        self.request_index(date, article_list)
+      if snapshot is not None:
+        for article in article_list:
+          article['label'] = snapshot.get_label(article)
+      yield date, article_list
+
+
+  def retrieve_articles_range(self, start, end):
+    '''
+    @function - retrieve articles published between start and end inclusive
+    @param start - date string of format yyyy-mm-dd
+    @param end - date string of format yyyy-mm-dd
+    @return - a list of article dict ordered by date, owned by the caller
+    '''
+    article_list = []
+    for date, date_articles in self.iter_articles_range(start, end):
+      article_list += date_articles
+    return article_list
+
+
+  def get_sentiment_rollup(self, date):
+    '''
+    @param date - date string of format yyyy-mm-dd
+    @return - {sentiment label: list of article dict} of the analyzed articles of the date, owned by the caller
+    '''
+    date = date.replace("-", "/")
+    rollup = self.analysis_cache.get(('sentiment', date))
+    if rollup is None:
+      rollup = self.article_db.get_sentiment_rollup(date)
+      # the analyzer writes the rollup after the crawl, an empty rollup only lives for a short ttl
+      # and a partial one for the recent ttl of the analysis cache
+      if len(rollup) > 0:
+        self.analysis_cache.set(('sentiment', date), rollup)
+      else:
+        self.analysis_cache.set(('sentiment', date), rollup, ttl=empty_rollup_ttl)
+    return {sentiment: [dict(article) for article in article_list] for sentiment, article_list in rollup.items()}
+
+
+  def get_entity_articles(self, entity, user_id=None):
+    '''
+    @param entity - entity name, matched case insensitively
+    @param user_id - if set, article['label'] is set to the user preference of each article
+    @return - list of article dict mentioning the entity, newest first
+    '''
+    article_list = self.analysis_cache.get(('entity', entity.lower()))
+    if article_list is None:
+      article_list = self.article_db.get_articles_by_entity(entity)
+      self.analysis_cache.set(('entity', entity.lower()), article_list)
+    article_list = [dict(article) for article in article_list]
+    if user_id:
+      self.label_articles(user_id, article_list)
+    return article_list
+
+
+  def get_crawl_status(self, date):
+    '''
+    @param date - date string of format yyyy-mm-dd
+    @return - {'date': str, 'status': 'pending' | 'done' | 'failed' | 'none', 'article_count': int}
+    '''
+    return self.crawl_scheduler.get_status(date.replace("/", "-"))
+
+
+  def on_crawl_complete(self, date, article_list):
+    '''
+    Back fill the article cache and the search index once a background crawl finished
+    @param date - date string of format yyyy-mm-dd
+    '''
+    for article in article_list:
+      article['article_id'] = getTitleHash(article['title'])
+      article.pop("text", None)
+    self.article_cache.put(date.replace("-", "/"), article_list)
+    self.analysis_cache.pop(('sentiment', date.replace("-", "/")))
+    self.index_day(date, article_list)
+
+
+  def request_index(self, date, article_list):
+    '''
+    Index a day in the background unless it is indexed or being indexed already,
+    a day indexed empty is indexed again once it has articles
+    @param date - date string of format yyyy-mm-dd or yyyy/mm/dd
+    '''
+    date = date.replace("/", "-")
+    with self._index_lock:
+      if date in self.indexing_days or self.search_index.has_day(date):
+        return
+      if len(article_list) == 0 and self.search_index.has_empty_day(date):
+        return
+      self.indexing_days.add(date)
+    self.index_executor.submit(self.index_day, date, [dict(article) for article in article_list])
+
+
+  def index_day(self, date, article_list):
+    '''
+    @param date - date string of format yyyy-mm-dd
+    '''
+    try:
+      self.search_index.add_day(date, article_list)
+    except Exception as e:
+      print("[error] indexing articles of {} failed".format(date))
+      print(e)
+    finally:
+      with self._index_lock:
+        self.indexing_days.discard(date)
+
+
+  def search_articles(self, query, user_id=None, limit=20):
+    '''
+    Full text search of the articles
+    @param query - free text query
+    @param user_id - if set, article['label'] is set to the user preference of each article
+    @return - list of article dict ranked by relevance
+    '''
+    article_list = self.search_index.search(query, limit)
+    if user_id:
+      self.label_articles(user_id, article_list)
     return article_list
 
 
@@ -68,35 +283,125 @@ class TCArticleManager:
     return self.article_db.get_article_by_id(title)
 
 
+  def find_article(self, article_id, date=None):
+    '''
+    Look up an article by id, from the cached article list of its date when the date is known,
+    otherwise from the article_id index of the database
+    @param article_id - article id
+    @param date - optional date string of format yyyy-mm-dd or yyyy/mm/dd
+    @return - article dict, or None if not found
+    '''
+    if date:
+      # never crawls, the date comes from the client
+      date = date.replace("-", "/")
+      article_list = self.article_cache.get(date)
+      if article_list is None:
+        article_list = self.article_db.get_articles_by_date(date)
+      for article in article_list:
+        if article['article_id'] == article_id:
+          return article
+    article = self.article_db.get_article_by_id(article_id)
+    return article if article else None
+
+
   # User labeled article preferences related opeations
-  @lru_cache(maxsize=5)
+  def get_user_pref_snapshot(self, user_id):
+    '''
+    Get all preferences of a user, served from the per-user cache when warm,
+    otherwise loaded from db with a single query
+    @param user_id - user id
+    @return UserPrefSnapshot
+    '''
+    snapshot = self.user_pref_cache.get(user_id)
+    if snapshot is None:
+      print("getting user [{}] preferences from db".format(user_id))
+      snapshot = UserPrefSnapshot(user_id, self.user_pref_db.get_all_articles(user_id))
+      self.user_pref_cache.set(user_id, snapshot)
+    return snapshot
+
+
   def get_user_likes(self, user_id):
     '''
     Get list of user liked articles
     @param user_id - user id
     '''
-    print("getting user [{}] liked article from db".format(user_id))
-    return self.user_pref_db.get_articles_by_preference(user_id, 'like')
+    return self.get_user_pref_snapshot(user_id).get_articles('like')
 
 
-  @lru_cache(maxsize=5)
   def get_user_dislikes(self, user_id):
     '''
     Get list of user disliked articles
     @param user_id - user id
     '''
-    print("getting user [{}] disliked article from db".format(user_id))
-    return self.user_pref_db.get_articles_by_preference(user_id, 'dislike')
+    return self.get_user_pref_snapshot(user_id).get_articles('dislike')
 
 
-  @lru_cache(maxsize=5)
   def get_user_uncertains(self, user_id):
     '''
     Get list of user uncertain articles
     @param user_id - user id
     '''
-    print("getting user [{}] uncertained article from db".format(user_id))
-    return self.user_pref_db.get_articles_by_preference(user_id, 'uncertain')
+    return self.get_user_pref_snapshot(user_id).get_articles('uncertain')
+
+
+  def label_articles(self, user_id, article_list):
+    '''
+    Set article['label'] to the user preference of each article in the list
+    @param user_id - user id
+    @param article_list - list of article dict
+    '''
+    snapshot = self.get_user_pref_snapshot(user_id)
+    for article in article_list:
+      article['label'] = snapshot.get_label(article)
+    return article_list
+
+
+  def get_recommendations(self, user_id):
+    '''
+    "For you" feed of the user, precomputed offline by text-processor/recommendation-builder.py
+    @param user_id - user id
+    @return - list of article dict, best first, without the articles labeled since the feed was built
+    '''
+    article_list = self.analysis_cache.get(('recommendations', user_id))
+    if article_list is None:
+      article_list = self.user_pref_db.get_recommendations(user_id)
+      self.analysis_cache.set(('recommendations', user_id), article_list)
+    snapshot = self.get_user_pref_snapshot(user_id)
+    return [dict(article) for article in article_list if snapshot.get_label(article) == '']
+
+
+  def get_user_profile(self, user_id):
+    '''
+    Ranking profile of a user, built from the preference snapshot on first use
+    and kept with it, so it expires and reloads together with the snapshot
+    @return UserProfile
+    '''
+    snapshot = self.get_user_pref_snapshot(user_id)
+    if getattr(snapshot, 'profile', None) is None:
+      snapshot.profile = UserProfile({pref: snapshot.get_articles(pref) for pref in snapshot.preference_types})
+    return snapshot.profile
+
+
+  def rank_articles(self, user_id, article_list):
+    '''
+    Sort the article list in place, most relevant to the user first.
+    The list keeps its order if the user has no preferences yet.
+    @param user_id - user id
+    @param article_list - list of article dict
+    '''
+    profile = self.get_user_profile(user_id)
+    if len(article_list) < 2 or profile.is_empty():
+      return article_list
+
+    # entities are added by the analyzer after the crawl, a list ranked before then is hashed again
+    key = tuple((article['article_id'], tuple(article.get('entities') or ())) for article in article_list)
+    feature_matrix = self.feature_cache.get(key)
+    if feature_matrix is None:
+      feature_matrix = FeatureMatrix(article_list)
+      self.feature_cache.set(key, feature_matrix)
+    order = np.argsort(-profile.score(feature_matrix), kind='stable')
+    article_list[:] = [article_list[i] for i in order]
+    return article_list
 
 
   def record_liked_article(self, user_id, article):
@@ -106,13 +411,8 @@ class TCArticleManager:
     @param user_id - user id
     @param article - {'title': string, 'date': 'yyyy-mm-dd'}
     '''
-    # clear cache upon preference write update
-    self.clear_user_pref_cache('like')
-    self.clear_user_pref_cache(article['prev_label'])
-
     print("user [{}] liked [{}]".format(user_id, article['title']))
-    article['article_id'] = getTitleHash(article['title'])
-    self.user_pref_db.record_single_preference(user_id, article, 'like')
+    self.record_article_preference(user_id, article, 'like')
 
 
   def record_dislike_article(self, user_id, article):
@@ -121,12 +421,8 @@ class TCArticleManager:
     @param user_id - user id
     @param article - {'title': string, 'date': 'yyyy-mm-dd'}
     '''
-    self.clear_user_pref_cache('dislike')
-    self.clear_user_pref_cache(article['prev_label'])
-
     print("user [{}] disliked [{}]".format(user_id, article['title']))
-    article['article_id'] = getTitleHash(article['title'])
-    self.user_pref_db.record_single_preference(user_id, article, 'dislike')
+    self.record_article_preference(user_id, article, 'dislike')
 
 
   def record_uncertain_article(self, user_id, article):
@@ -135,23 +431,44 @@ class TCArticleManager:
     @param user_id - user id
     @param article - {'title': string, 'date': 'yyyy-mm-dd'}
     '''
-    self.clear_user_pref_cache('uncertain')
-    self.clear_user_pref_cache(article['prev_label'])
-
     print("user [{}] is uncertain about [{}]".format(user_id, article['title']))
+    self.record_article_preference(user_id, article, 'uncertain')
+
+
+  def record_article_preference(self, user_id, article, preference):
+    '''
+    Write the preference to database and update the cached snapshot of the user in place,
+    so the next page view of the user does not need to reload from db
+    @param user_id - user id
+    @param article - {'title': string, 'date': 'yyyy-mm-dd'}
+    @param preference - 'like', 'dislike', 'uncertain'
+    '''
     article['article_id'] = getTitleHash(article['title'])
-    self.user_pref_db.record_single_preference(user_id, article, 'uncertain')
+    self.user_pref_db.record_single_preference(user_id, article, preference)
 
+    snapshot = self.user_pref_cache.get(user_id)
+    if snapshot is not None:
+      prev_article, prev_preference = snapshot.set_preference(article, preference)
+      if getattr(snapshot, 'profile', None) is not None:
+        snapshot.profile.update(article, preference, prev_article, prev_preference)
 
-  def clear_user_pref_cache(self, preference):
-    if preference == 'like':
-      self.get_user_likes.cache_clear()
-    elif preference == 'dislike':
-      self.get_user_dislikes.cache_clear()
-    elif preference == 'uncertain':
-      self.get_user_uncertains.cache_clear()
 
-    
+  def record_preference_by_id(self, user_id, article_id, preference, date=None):
+    '''
+    Record a preference for an article known only by id
+    @param user_id - user id
+    @param article_id - article id
+    @param preference - 'like', 'dislike', 'uncertain'
+    @param date - optional date string of the article, saves a database lookup when its articles are cached
+    @return - the recorded article dict, or None if the article does not exist
+    '''
+    article = self.find_article(article_id, date)
+    if article is None:
+      return None
+    print("user [{}] labeled [{}] as {}".format(user_id, article['title'], preference))
+    self.record_article_preference(user_id, article, preference)
+    return article
+
 
 ## this is for debugging
 ## to manually run mongodb on local host:
@@ -184,6 +501,7 @@ if __name__ == '__main__':
   #   print(str(article))
   #   dynamoDbHelper_2.put_article_preference("ruizeng", article, preference='like')
   import time
+  from aws_gateway import AWS_Article_DB
 
   aws_article_db = AWS_Article_DB()
   mongo_article_collection = pymongo.MongoClient("mongodb://localhost:27017/")["TC-Article"]["techcrunch"]
@@ -3,11 +3,67 @@ import botocore
 import logging
 from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key, Attr
+from storage import Article_DB, Pref_DB, normalize_entity
 
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 os.environ['aws_default_region'] = 'us-west-1'
 boto3.setup_default_session(region_name='us-west-1')
 
+# attributes rendered by the web pages, plus the entities the ranking uses,
+# the analyzer's sentiment maps are left out
+article_attributes = ('article_id', 'title', 'date', 'url', 'entities')
+# entities are kept with the preference so the ranking profile hashes the same features as the article
+preference_attributes = ('article_id', 'title', 'date', 'url', 'entities', 'preference')
+
+# adjacency items of the entity and sentiment index, written by text-processor/article-retriever.py
+#   date='ENTITY#<entity>',        article_id='<yyyy/mm/dd>#<article_id>'
+#   date='SENTIMENT#<yyyy/mm/dd>', article_id='<SENTIMENT>#<article_id>'
+entity_index_prefix = 'ENTITY#'
+sentiment_index_prefix = 'SENTIMENT#'
+index_attributes = ('article_id', 'title', 'url', 'sentiment')
+
+# bulk article reads
+date_query_workers = 8
+batch_get_size = 100
+batch_get_max_attempts = 8
+batch_get_backoff_sec = 0.05
+
+def get_projection(attributes, names=None):
+    '''
+    @param attributes - names of the attributes to return
+    @param names - ExpressionAttributeNames already used by the request
+    @return - ProjectionExpression and ExpressionAttributeNames arguments of a dynamodb read
+    '''
+    # attribute names are aliased, 'date' and 'url' are dynamodb reserved words
+    aliases = {'#p{}'.format(i): attribute for i, attribute in enumerate(attributes)}
+    return {'ProjectionExpression': ', '.join(aliases),
+            'ExpressionAttributeNames': dict(names or {}, **aliases)}
+
+def query_items(table, attributes=None, **kwargs):
+    '''
+    Generator over all items of a dynamodb query, following LastEvaluatedKey
+    past the 1MB page limit
+    @param table - boto3 dynamodb Table
+    @param attributes - names of the attributes to return, all attributes if None
+    @param kwargs - other arguments of table.query
+    '''
+    if attributes:
+        kwargs.update(get_projection(attributes, kwargs.get('ExpressionAttributeNames')))
+    while True:
+        response = table.query(**kwargs)
+        if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+            print("Error querying dynamodb table {}".format(table.name))
+            return
+        for item in response['Items']:
+            yield item
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
 ### https://boto3.amazonaws.com/v1/documentation/api/latest/guide/quickstart.html
 class AWS_S3_Helper:
     def __init__(self):
@@ -57,9 +113,12 @@ class AWS_S3_Helper:
         logging.info(response)
 
 
-class AWS_Pref_DB:
-    def __init__(self, table_name='MyArticlePreferenceTable', region_name='us-east-1'):
+class AWS_Pref_DB(Pref_DB):
+    def __init__(self, table_name='MyArticlePreferenceTable', region_name='us-east-1',
+                 recommendation_table_name='UserRecommendationTable'):
         self.table = boto3.resource('dynamodb').Table(table_name)
+        # written by text-processor/recommendation-builder.py, one item per user_id
+        self.recommendation_table = boto3.resource('dynamodb').Table(recommendation_table_name)
 
     def record_single_preference(self, user_id, article, preference):
         '''
@@ -103,6 +162,9 @@ class AWS_Pref_DB:
                 'title': article['title'], 
                 'date': article['date'],
                 'preference': 'uncertain'})
+        for item, article in zip(article_list, liked_articles + dislike_articles + uncertain_articles):
+            if article.get('entities'):
+                item['entities'] = list(article['entities'])
         with self.table.batch_writer() as batch:
             for article in article_list:
                 batch.put_item(Item=article)
@@ -115,20 +177,14 @@ class AWS_Pref_DB:
         '''
         result = {'like':{}, 'dislike':{}, 'uncertain':{}}
 
-        response = self.table.query(KeyConditionExpression=Key('user_id').eq(user_id))
-
-        if response['ResponseMetadata']['HTTPStatusCode'] != 200:
-            # request failure
-            return result
-        if len(response['Items']) == 0:
-            # no entry
-            return result
-
-        for item in response['Items']:
+        items = query_items(self.table, preference_attributes,
+                            KeyConditionExpression=Key('user_id').eq(user_id))
+        for item in items:
             article_metadata = {'title': item['title'], 
                                 'date': item['date'], 
                                 'article_id': item['article_id'],
-                                'url': item['url']}
+                                'url': item.get('url'),
+                                'entities': item.get('entities', [])}
 
             if item['preference'] == 'like':
                 result['like'][item['article_id']] = article_metadata
@@ -145,18 +201,9 @@ class AWS_Pref_DB:
         @param user_id - user id
         @return - list of articles -> {'title': str, 'date': 'yyyy-mm-dd', 'url': str, 'article_id' = str}
         '''
-        result = []
-        response = self.table.query(KeyConditionExpression=Key('user_id').eq(user_id))
-
-        if response['ResponseMetadata']['HTTPStatusCode'] != 200:
-            # request failure
-            return result
-        if len(response['Items']) == 0:
-            # no entry
-            return result
-
-        result = [item for item in response['Items'] if item['preference'] == preference]
-        return result
+        return list(query_items(self.table, preference_attributes,
+                                KeyConditionExpression=Key('user_id').eq(user_id),
+                                FilterExpression=Attr('preference').eq(preference)))
     
     def put_article_preference(self, user_id, article, preference):
         assert article['article_id'] is not None
@@ -171,13 +218,43 @@ class AWS_Pref_DB:
 
         if 'url' in article:
             item['url'] = article['url']
+        if article.get('entities'):
+            item['entities'] = list(article['entities'])
 
         self.table.put_item(Item=item)
 
+    def get_recommendations(self, user_id):
+        '''
+        Precomputed "For you" feed of the user
+        @param user_id - user id
+        @return - list of articles -> {'title': str, 'date': 'yyyy/mm/dd', 'url': str, 'article_id': str, 'score': Decimal}
+        '''
+        response = self.recommendation_table.get_item(Key={'user_id': user_id})
+        if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+            print("Error retrieving recommendations of user {}".format(user_id))
+            return []
+        return response.get('Item', {}).get('articles', [])
+
+
+class AWS_Article_DB(Article_DB):
+    # filled by the scraper lambda, see lambda_tc_article_crawler/handler.py
+    has_scraper = True
 
-class AWS_Article_DB:
     def __init__(self, table_name='ArticleMetadata', region_name='us-east-1'):
-        self.table = boto3.resource('dynamodb', region_name=region_name).Table(table_name)
+        self.table_name = table_name
+        self.region_name = region_name
+        self.dynamodb = boto3.resource('dynamodb', region_name=region_name)
+        self.table = self.dynamodb.Table(table_name)
+        # boto3 resources are not thread safe, each query worker gets its own,
+        # the workers live as long as the gateway so the resources are created once per worker
+        self.thread_local = threading.local()
+        self.query_executor = ThreadPoolExecutor(max_workers=date_query_workers)
+
+    def get_thread_table(self):
+        if not hasattr(self.thread_local, 'table'):
+            session = boto3.session.Session(region_name=self.region_name)
+            self.thread_local.table = session.resource('dynamodb').Table(self.table_name)
+        return self.thread_local.table
 
     def put_single_article(self, article):
         self.validate_article(article)
@@ -199,18 +276,98 @@ class AWS_Article_DB:
                         'url': article['url']}
                 batch.put_item(Item=item)
 
-    def get_articles_by_date(self, date):
+    def get_articles_by_date(self, date, attributes=article_attributes):
         '''
         @ date - date string of formate yyyy/MM/dd
+        @ attributes - names of the attributes to return, all attributes if None
         '''
-        response = self.table.query(KeyConditionExpression=Key('date').eq(date))
-        if response['ResponseMetadata']['HTTPStatusCode'] != 200:
-            print("Error retrieving articles from dynamodb for date = {}".format(date))
-            return []
-        if len(response['Items']) == 0:
+        article_list = list(query_items(self.table, attributes, KeyConditionExpression=Key('date').eq(date)))
+        if len(article_list) == 0:
             print("Empty entry from dynamodb for date = {}".format(date))
-            return []
-        return [article for article in response['Items']]
+        return article_list
+
+    def iter_articles_by_dates(self, dates, attributes=article_attributes):
+        '''
+        Query the dates concurrently, yielding each date as soon as it and the dates before it are read
+        @ dates - list of date strings of formate yyyy/MM/dd
+        @ attributes - names of the attributes to return, all attributes if None
+        @ return - generator of (date, list of article dict), ordered as the dates
+        '''
+        def query_date(date):
+            return list(query_items(self.get_thread_table(), attributes, KeyConditionExpression=Key('date').eq(date)))
+
+        for date, date_articles in zip(dates, self.query_executor.map(query_date, dates)):
+            yield date, date_articles
+
+    def get_articles_by_dates(self, dates, attributes=article_attributes):
+        '''
+        @ dates - list of date strings of formate yyyy/MM/dd
+        @ attributes - names of the attributes to return, all attributes if None
+        @ return - list of article dict, ordered as the dates
+        '''
+        article_list = []
+        for date, date_articles in self.iter_articles_by_dates(dates, attributes):
+            article_list += date_articles
+        return article_list
+
+    def get_articles_by_ids(self, keys, attributes=article_attributes):
+        '''
+        Look up articles with BatchGetItem, retrying unprocessed keys with backoff
+        @ keys - list of {'date': 'yyyy/MM/dd', 'article_id': str}
+        @ attributes - names of the attributes to return, all attributes if None
+        @ return - list of article dict in the order of the keys, missing articles are left out
+        '''
+        keys = [{'date': key['date'], 'article_id': key['article_id']} for key in keys]
+        unique_keys = list({(key['date'], key['article_id']): key for key in keys}.values())
+        found = {}
+        for i in range(0, len(unique_keys), batch_get_size):
+            request = {'Keys': unique_keys[i:i + batch_get_size]}
+            if attributes:
+                # the key attributes are needed to match items back to the keys
+                request.update(get_projection(tuple(set(attributes) | {'date', 'article_id'})))
+
+            for attempt in range(batch_get_max_attempts):
+                response = self.dynamodb.batch_get_item(RequestItems={self.table_name: request})
+                for item in response['Responses'].get(self.table_name, []):
+                    found[(item['date'], item['article_id'])] = item
+                unprocessed = response.get('UnprocessedKeys', {}).get(self.table_name)
+                if not unprocessed:
+                    break
+                request = unprocessed
+                time.sleep(random.uniform(0, batch_get_backoff_sec * (2 ** attempt)))
+            else:
+                print("[error] {} article keys left unprocessed by BatchGetItem".format(len(request['Keys'])))
+
+        return [found[(key['date'], key['article_id'])] for key in keys if (key['date'], key['article_id']) in found]
+
+    def get_articles_by_entity(self, entity, limit=100):
+        '''
+        One query on the entity partition, newest first
+        '''
+        items = query_items(self.table, index_attributes,
+                            KeyConditionExpression=Key('date').eq(entity_index_prefix + normalize_entity(entity)),
+                            ScanIndexForward=False)
+        article_list = []
+        for item in items:
+            date, article_id = item['article_id'].split('#', 1)
+            article_list.append({'article_id': article_id, 'date': date, 'title': item['title'],
+                                 'url': item.get('url'), 'sentiment': item.get('sentiment')})
+            if len(article_list) >= limit:
+                break
+        return article_list
+
+    def get_sentiment_rollup(self, date):
+        '''
+        One query on the sentiment partition of the date
+        '''
+        rollup = {}
+        items = query_items(self.table, index_attributes,
+                            KeyConditionExpression=Key('date').eq(sentiment_index_prefix + date))
+        for item in items:
+            sentiment, article_id = item['article_id'].split('#', 1)
+            rollup.setdefault(sentiment, []).append({'article_id': article_id, 'date': date, 'title': item['title'],
+                                                     'url': item.get('url'), 'sentiment': sentiment})
+        return rollup
 
     def get_article_by_id(self, article_id):
         response = self.table.query(IndexName='article_id-index',
@@ -0,0 +1,256 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from types import MappingProxyType
+
+class TTLCache:
+    '''
+    Bounded, thread safe LRU cache whose entries expire after a time-to-live.
+    Used by the web tier to hold per-user and per-date data in memory so a
+    warm page view does not need to go back to dynamodb.
+    '''
+    def __init__(self, max_entries=128, ttl=300, max_bytes=None):
+        '''
+        @param max_entries - max number of entries before least recently used ones are evicted
+        @param ttl - default seconds an entry stays valid after it is set
+        @param max_bytes - optional bound on the total size passed to set(), evicts lru entries beyond it
+        '''
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expire_at, size = entry
+            if expire_at <= time.time():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, size=0):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, time.time() + ttl, size)
+            self.total_bytes += size
+            while len(self._entries) > self.max_entries or \
+                    (self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self._entries) > 1):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+        return entry
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._remove(key)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self.total_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > time.time()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class UserPrefSnapshot:
+    '''
+    All article preferences of a single user, loaded with one query.
+    Articles are kept per preference type and keyed by article_id,
+    together with the lower cased title set used to label article lists.
+    '''
+    preference_types = ('like', 'dislike', 'uncertain')
+
+    def __init__(self, user_id, preferences):
+        '''
+        @param user_id - user id
+        @param preferences - {'like': {article_id: article}, 'dislike': {...}, 'uncertain': {...}}
+        '''
+        self.user_id = user_id
+        self.articles = {pref: dict(preferences.get(pref, {})) for pref in self.preference_types}
+        self.titles = {pref: set(article['title'].strip().lower() for article in self.articles[pref].values())
+                        for pref in self.preference_types}
+        # bumped on every change, the etag is recomputed lazily once per version
+        self.version = 0
+        self._etag = None
+        self._lock = threading.Lock()
+
+    def get_articles(self, preference):
+        '''
+        @return - list of article dict labeled with preference, copied so callers can sort or modify it
+        '''
+        with self._lock:
+            return [dict(article) for article in self.articles.get(preference, {}).values()]
+
+    def get_label(self, article):
+        '''
+        @param article - article dict with at least 'title', optionally 'article_id'
+        @return - 'like', 'dislike', 'uncertain' or '' if not labeled
+        '''
+        article_id = article.get('article_id')
+        title = article['title'].strip().lower()
+        with self._lock:
+            for pref in self.preference_types:
+                if article_id in self.articles[pref] or title in self.titles[pref]:
+                    return pref
+        return ''
+
+    def get_etag(self):
+        '''
+        @return - hash of the (preference, article_id) pairs, equal for equal preferences
+                  even across snapshots reloaded from db
+        '''
+        with self._lock:
+            if self._etag is None:
+                labels = sorted((pref, article_id) for pref in self.preference_types for article_id in self.articles[pref])
+                self._etag = hashlib.sha256(repr(labels).encode()).hexdigest()
+            return self._etag
+
+    def set_preference(self, article, preference):
+        '''
+        Move the article into the given preference bucket,
+        removing it from whatever bucket it was in before.
+        @param article - {'article_id': str, 'title': str, 'date': str, 'url': str (optional), 'entities': list (optional)}
+        @return - (article dict, preference) the article was stored with before, (None, None) if it was not
+        '''
+        previous = (None, None)
+        article_id = article['article_id']
+        title = article['title'].strip().lower()
+        with self._lock:
+            for pref in self.preference_types:
+                removed = self.articles[pref].pop(article_id, None)
+                if removed is not None:
+                    self.titles[pref].discard(removed['title'].strip().lower())
+                    previous = (removed, pref)
+                self.titles[pref].discard(title)
+            self.articles[preference][article_id] = {
+                'article_id': article_id,
+                'title': article['title'],
+                'date': article['date'],
+                'url': article.get('url'),
+                'entities': list(article.get('entities') or [])}
+            self.titles[preference].add(title)
+            self.version += 1
+            self._etag = None
+        return previous
+
+
+class ArticleCache:
+    '''
+    Per-date cache of article lists.
+    Entries are stored as tuples of read only dicts so nothing handed out can change them,
+    readers get shallow dict copies they are free to label or trim.
+    Historical dates never change and are kept for a long time,
+    today and yesterday may still get new articles and expire quickly.
+    '''
+    def __init__(self, max_entries=64, max_bytes=None, history_ttl=24 * 60 * 60, recent_ttl=5 * 60, recent_days=1):
+        '''
+        @param max_entries - max number of cached dates
+        @param max_bytes - optional bound on the approximate total size of cached articles
+        @param history_ttl - seconds to keep dates older than recent_days
+        @param recent_ttl - seconds to keep today and the last recent_days dates
+        @param recent_days - how many days before today are considered recent
+        '''
+        self.history_ttl = history_ttl
+        self.recent_ttl = recent_ttl
+        self.recent_days = recent_days
+        self.cache = TTLCache(max_entries=max_entries, ttl=history_ttl, max_bytes=max_bytes)
+
+    def get(self, date, full_content=False):
+        '''
+        @param date - date string of format yyyy/mm/dd
+        @return - list of article dict copies, or None on cache miss
+        '''
+        entry = self.cache.get((date, full_content))
+        if entry is None:
+            return None
+        return [dict(article) for article in entry]
+
+    def get_many(self, dates, full_content=False):
+        '''
+        @param dates - list of date strings of format yyyy/mm/dd
+        @return - ({date: list of article dict copies} of the cached dates, list of the missing dates in order)
+        '''
+        found = {}
+        missing = []
+        for date in dates:
+            article_list = self.get(date, full_content)
+            if article_list is None:
+                missing.append(date)
+            else:
+                found[date] = article_list
+        return found, missing
+
+    def put(self, date, article_list, full_content=False):
+        '''
+        Freeze and cache the article list of a date. Empty lists are not cached,
+        as they mean the date has not been crawled yet.
+        @param date - date string of format yyyy/mm/dd
+        @param article_list - list of article dict
+        '''
+        if not article_list:
+            return
+        # lists such as the article entities are frozen into tuples
+        entry = tuple(MappingProxyType({key: tuple(value) if isinstance(value, list) else value
+                                        for key, value in article.items()})
+                      for article in article_list)
+        self.cache.set((date, full_content), entry, ttl=self.get_ttl(date), size=self.get_size(entry))
+
+    def invalidate(self, date):
+        self.cache.pop((date, False))
+        self.cache.pop((date, True))
+
+    def get_ttl(self, date):
+        try:
+            date_obj = datetime.strptime(date, "%Y/%m/%d")
+        except ValueError:
+            return self.recent_ttl
+        oldest_recent = datetime.today() - timedelta(days=self.recent_days + 1)
+        return self.recent_ttl if date_obj >= oldest_recent else self.history_ttl
+
+    def get_size(self, entry):
+        '''
+        Approximate size in bytes of a cached entry, counting the string values only
+        '''
+        size = 0
+        for article in entry:
+            for key, value in article.items():
+                if isinstance(value, str):
+                    size += len(key) + len(value)
+                elif isinstance(value, tuple):
+                    size += len(key) + sum(len(item) for item in value if isinstance(item, str))
+        return size
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,135 @@
+# Load test of the web app against the local sqlite storage, no AWS needed
+#
+# $python load_test.py --days 30 --articles 40 --users 50 --threads 8 --requests 2000
+#
+# Synthetic articles and preferences are seeded into a fresh sqlite file, then
+# concurrent clients browse article pages, preference pages and post likes
+# through the flask test client. Latency percentiles are reported per route.
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+# the storage backend is picked when application is imported
+os.environ['NEWSFEED_STORAGE'] = 'sqlite'
+os.environ.setdefault('NEWSFEED_SQLITE_PATH', os.path.join(tempfile.mkdtemp(), 'load_test.sqlite3'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from application import application, article_manager
+from article_manager import getTitleHash
+
+first_date = datetime(2019, 9, 1)
+entity_names = ('Apple', 'Google', 'Tesla', 'Sequoia Capital', 'SpaceX', 'Amazon')
+sentiment_labels = ('POSITIVE', 'NEGATIVE', 'NEUTRAL', 'MIXED')
+
+def seed(days, articles_per_day, users, prefs_per_user, rand):
+    '''
+    @return - list of seeded date strings of format yyyy-mm-dd
+    '''
+    dates = []
+    all_articles = []
+    for day in range(days):
+        date = first_date + timedelta(days=day)
+        article_list = []
+        for i in range(articles_per_day):
+            title = 'article {} of {}'.format(i, date.strftime('%Y-%m-%d'))
+            article_list.append({
+                'article_id': getTitleHash(title),
+                'title': title,
+                'date': date.strftime('%Y/%m/%d'),
+                'url': 'https://techcrunch.com/{}/{}'.format(date.strftime('%Y/%m/%d'), i)})
+        article_manager.article_db.put_articles(article_list)
+        # synthetic analysis, so the entity pages and sentiment filters have something to show
+        article_manager.article_db.put_article_analysis([
+            dict(article, entities=rand.sample(entity_names, 2), sentiment={'Sentiment': rand.choice(sentiment_labels)})
+            for article in article_list])
+        all_articles += article_list
+        dates.append(date.strftime('%Y-%m-%d'))
+
+    for user in range(users):
+        picked = rand.sample(all_articles, min(prefs_per_user, len(all_articles)))
+        article_manager.user_pref_db.record_preference_list(
+            'user{}'.format(user), picked[0::3], picked[1::3], picked[2::3])
+    return dates
+
+def run_client(requests, dates, users, rand, latencies, errors, lock):
+    client = application.test_client()
+    uid = 'user{}'.format(rand.randrange(users))
+    with client.session_transaction() as session:
+        session['uid'] = uid
+
+    for _ in range(requests):
+        roll = rand.random()
+        date = rand.choice(dates)
+        if roll < 0.6:
+            route = 'article page'
+            call = lambda: client.get('/Techcrunch/{}'.format(date))
+        elif roll < 0.65:
+            route = 'sentiment filter'
+            call = lambda: client.get('/Techcrunch/{}?sentiment={}'.format(date, rand.choice(sentiment_labels).lower()))
+        elif roll < 0.7:
+            route = 'entity page'
+            call = lambda: client.get('/Entity/{}'.format(rand.choice(entity_names)))
+        elif roll < 0.9:
+            route = 'preference page'
+            call = lambda: client.get('/User/{}/{}'.format(uid, rand.choice(('like', 'dislike', 'uncertain'))))
+        else:
+            route = 'like post'
+            article_id = getTitleHash('article {} of {}'.format(rand.randrange(10), date))
+            call = lambda: client.post('/api/preference', json={
+                'article_id': article_id,
+                'action': rand.choice(('like', 'dislike', 'uncertain')),
+                'date': date})
+
+        start_time = time.time()
+        response = call()
+        seconds = time.time() - start_time
+        with lock:
+            latencies[route].append(seconds)
+            if response.status_code != 200:
+                errors[route] += 1
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--articles', type=int, default=40, help='articles per day')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--prefs', type=int, default=60, help='preferences per user')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000, help='total requests')
+    args = parser.parse_args()
+
+    rand = random.Random(0)
+    dates = seed(args.days, args.articles, args.users, args.prefs, rand)
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    threads = [threading.Thread(target=run_client, args=(
+        args.requests // args.threads, dates, args.users, random.Random(i), latencies, errors, lock))
+        for i in range(args.threads)]
+
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start_time
+
+    total = sum(len(values) for values in latencies.values())
+    print("{} requests in {:.2f}s, {:.1f} requests/s".format(total, seconds, total / max(seconds, 1e-9)))
+    for route, values in sorted(latencies.items()):
+        values.sort()
+        print("{:>16}: {:>6} requests, {:>4} errors, p50 {:>7.2f} ms, p90 {:>7.2f} ms, p99 {:>7.2f} ms".format(
+            route, len(values), errors[route],
+            percentile(values, 0.5) * 1000, percentile(values, 0.9) * 1000, percentile(values, 0.99) * 1000))
+    print("article cache: {}".format(article_manager.article_cache.stats()))
+    print("user preference cache: {}".format(article_manager.user_pref_cache.stats()))
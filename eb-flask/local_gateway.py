@@ -0,0 +1,222 @@
+import json
+import sqlite3
+import threading
+
+from storage import Article_DB, Pref_DB, normalize_entity
+
+# SQLite stand-ins for the dynamodb tables in aws_gateway,
+# used to run the web app and its load tests locally
+
+def connect(path=':memory:'):
+    '''
+    One connection shared by every thread of the app, access is serialized by SQLiteTable._lock
+    '''
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    return connection
+
+
+class SQLiteTable:
+    # a connection shared by several tables shares their lock as well
+    _locks = {}
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = SQLiteTable._locks.setdefault(id(connection), threading.RLock())
+
+    def execute(self, sql, params=()):
+        with self._lock, self.connection:
+            return [dict(row) for row in self.connection.execute(sql, params)]
+
+    def executemany(self, sql, params_list):
+        with self._lock, self.connection:
+            self.connection.executemany(sql, params_list)
+
+
+class SQLite_Article_DB(Article_DB, SQLiteTable):
+    def __init__(self, connection):
+        SQLiteTable.__init__(self, connection)
+        with self._lock, self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS articles (
+                    date TEXT NOT NULL,
+                    article_id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    PRIMARY KEY (date, article_id))''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS articles_article_id ON articles (article_id)')
+            # local counterpart of the analyzer's entity and sentiment adjacency items
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS entity_index (
+                    entity TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    article_id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    url TEXT,
+                    sentiment TEXT,
+                    PRIMARY KEY (entity, date, article_id))''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS entity_index_article ON entity_index (date, article_id)')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS sentiment_index (
+                    date TEXT NOT NULL,
+                    article_id TEXT NOT NULL,
+                    sentiment TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    url TEXT,
+                    PRIMARY KEY (date, article_id))''')
+
+    def put_single_article(self, article):
+        self.put_articles([article])
+
+    def put_articles(self, article_list):
+        for article in article_list:
+            self.validate_article(article)
+        self.executemany(
+            'INSERT OR REPLACE INTO articles (date, article_id, title, url) VALUES (?, ?, ?, ?)',
+            [(article['date'], article['article_id'], article['title'], article['url']) for article in article_list])
+
+    def get_articles_by_date(self, date, attributes=None):
+        article_list = self.execute('SELECT article_id, title, date, url FROM articles WHERE date = ?', (date,))
+        if attributes:
+            article_list = [{key: article[key] for key in attributes if key in article} for article in article_list]
+        return article_list
+
+    def get_articles_by_dates(self, dates, attributes=None):
+        order = {date: i for i, date in enumerate(dates)}
+        article_list = self.execute(
+            'SELECT article_id, title, date, url FROM articles WHERE date IN ({})'.format(', '.join('?' * len(order))),
+            tuple(order))
+        article_list.sort(key=lambda article: order[article['date']])
+        if attributes:
+            article_list = [{key: article[key] for key in attributes if key in article} for article in article_list]
+        return article_list
+
+    def iter_articles_by_dates(self, dates, attributes=None):
+        articles_by_date = {date: [] for date in dates}
+        for article in self.get_articles_by_dates(dates, attributes):
+            articles_by_date[article['date']].append(article)
+        for date in dates:
+            yield date, articles_by_date[date]
+
+    def get_articles_by_ids(self, keys, attributes=None):
+        article_ids = list({key['article_id'] for key in keys})
+        found = {}
+        for article in self.execute(
+                'SELECT article_id, title, date, url FROM articles WHERE article_id IN ({})'.format(
+                    ', '.join('?' * len(article_ids))),
+                tuple(article_ids)):
+            found[(article['date'], article['article_id'])] = article
+        article_list = [found[(key['date'], key['article_id'])] for key in keys if (key['date'], key['article_id']) in found]
+        if attributes:
+            article_list = [{key: article[key] for key in attributes if key in article} for article in article_list]
+        return article_list
+
+    def put_article_analysis(self, article_list):
+        '''
+        Index analyzed articles, replacing what they were indexed under before
+        @param article_list - article dict with 'sentiment' ({'Sentiment': label, ...}) and 'entities' (list of str)
+        '''
+        entity_rows = []
+        sentiment_rows = []
+        for article in article_list:
+            sentiment = article['sentiment']['Sentiment'] if article.get('sentiment') else None
+            for entity in set(normalize_entity(entity) for entity in article.get('entities') or []):
+                if entity:
+                    entity_rows.append((entity, article['date'], article['article_id'], article['title'], article.get('url'), sentiment))
+            if sentiment:
+                sentiment_rows.append((article['date'], article['article_id'], sentiment, article['title'], article.get('url')))
+        with self._lock, self.connection:
+            self.connection.executemany('DELETE FROM entity_index WHERE date = ? AND article_id = ?',
+                                        [(article['date'], article['article_id']) for article in article_list])
+            self.connection.executemany('INSERT INTO entity_index VALUES (?, ?, ?, ?, ?, ?)', entity_rows)
+            self.connection.executemany('INSERT OR REPLACE INTO sentiment_index VALUES (?, ?, ?, ?, ?)', sentiment_rows)
+
+    def get_articles_by_entity(self, entity, limit=100):
+        return self.execute(
+            'SELECT article_id, date, title, url, sentiment FROM entity_index WHERE entity = ? '
+            'ORDER BY date DESC, article_id LIMIT ?', (normalize_entity(entity), limit))
+
+    def get_sentiment_rollup(self, date):
+        rollup = {}
+        for article in self.execute(
+                'SELECT article_id, date, title, url, sentiment FROM sentiment_index WHERE date = ?', (date,)):
+            rollup.setdefault(article['sentiment'], []).append(article)
+        return rollup
+
+    def get_article_by_id(self, article_id):
+        rows = self.execute('SELECT article_id, title, date, url FROM articles WHERE article_id = ? LIMIT 1', (article_id,))
+        return rows[0] if rows else []
+
+
+class SQLite_Pref_DB(Pref_DB, SQLiteTable):
+    def __init__(self, connection):
+        SQLiteTable.__init__(self, connection)
+        with self._lock, self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS preferences (
+                    user_id TEXT NOT NULL,
+                    article_id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    url TEXT,
+                    preference TEXT NOT NULL,
+                    entities TEXT,
+                    PRIMARY KEY (user_id, article_id))''')
+            # preference tables created before entities were kept
+            if 'entities' not in [row['name'] for row in self.connection.execute('PRAGMA table_info(preferences)')]:
+                self.connection.execute('ALTER TABLE preferences ADD COLUMN entities TEXT')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS preferences_user_preference ON preferences (user_id, preference)')
+            # one json list per user, like the items of the recommendation table
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS recommendations (
+                    user_id TEXT PRIMARY KEY,
+                    articles TEXT NOT NULL)''')
+
+    def record_preference_list(self, user_id, liked_articles, dislike_articles, uncertain_articles):
+        rows = []
+        for preference, articles in (('like', liked_articles), ('dislike', dislike_articles), ('uncertain', uncertain_articles)):
+            for article in articles:
+                rows.append((user_id, article['article_id'], article['title'], article['date'], article.get('url'), preference,
+                             json.dumps(list(article.get('entities') or []))))
+        self.executemany(
+            'INSERT OR REPLACE INTO preferences (user_id, article_id, title, date, url, preference, entities) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            rows)
+
+    def get_all_articles(self, user_id):
+        result = {'like':{}, 'dislike':{}, 'uncertain':{}}
+        for item in self.execute('SELECT * FROM preferences WHERE user_id = ?', (user_id,)):
+            if item['preference'] in result:
+                result[item['preference']][item['article_id']] = {
+                    'title': item['title'],
+                    'date': item['date'],
+                    'article_id': item['article_id'],
+                    'url': item['url'],
+                    'entities': json.loads(item['entities'] or '[]')}
+        return result
+
+    def get_articles_by_preference(self, user_id, preference):
+        items = self.execute('SELECT * FROM preferences WHERE user_id = ? AND preference = ?', (user_id, preference))
+        for item in items:
+            item['entities'] = json.loads(item['entities'] or '[]')
+        return items
+
+    def put_article_preference(self, user_id, article, preference):
+        assert article['article_id'] is not None
+        assert article['title'] is not None
+        assert article['date'] is not None
+        self.executemany(
+            'INSERT OR REPLACE INTO preferences (user_id, article_id, title, date, url, preference, entities) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(user_id, article['article_id'], article['title'], article['date'], article.get('url'), preference,
+              json.dumps(list(article.get('entities') or [])))])
+
+    def get_recommendations(self, user_id):
+        rows = self.execute('SELECT articles FROM recommendations WHERE user_id = ?', (user_id,))
+        return json.loads(rows[0]['articles']) if rows else []
+
+    def put_recommendations(self, user_id, article_list):
+        self.executemany('INSERT OR REPLACE INTO recommendations (user_id, articles) VALUES (?, ?)',
+                         [(user_id, json.dumps(article_list))])
@@ -0,0 +1,132 @@
+import re
+import threading
+import zlib
+
+import numpy as np
+
+# Personalized ranking of article lists
+#
+# Articles are hashed into sparse feature vectors over their title words and entities.
+# A user profile is the sum of the vectors of the articles the user labeled, weighted
+# by the label, and a list of articles is scored with one sparse matrix-vector product
+# against the profile.
+
+feature_bits = 14
+feature_dim = 1 << feature_bits
+preference_weights = {'like': 1.0, 'dislike': -1.0, 'uncertain': 0.0}
+# entities are more specific than title words
+entity_weight = 2.0
+
+token_pattern = re.compile(r"[a-z0-9]+")
+stop_words = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from', 'has', 'have', 'how',
+    'in', 'is', 'it', 'its', 'new', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'with', 'why'))
+
+def get_features(article):
+    '''
+    @param article - article dict with 'title' and optionally 'entities'
+    @return - {hashed feature index: weight}
+    '''
+    features = {}
+    names = [('w:' + token, 1.0) for token in token_pattern.findall(article['title'].lower()) if token not in stop_words]
+    names += [('e:' + ' '.join(entity.lower().split()), entity_weight) for entity in article.get('entities') or []]
+    for name, weight in names:
+        index = zlib.crc32(name.encode('utf-8')) & (feature_dim - 1)
+        features[index] = max(features.get(index, 0.0), weight)
+    return features
+
+
+class FeatureMatrix:
+    '''
+    Rows of l2 normalized article feature vectors in compressed sparse row form
+    '''
+    def __init__(self, article_list=()):
+        indices = []
+        values = []
+        offsets = [0]
+        for article in article_list:
+            features = get_features(article)
+            indices.extend(features.keys())
+            values.extend(features.values())
+            offsets.append(len(indices))
+        self.set_rows(np.array(indices, dtype=np.int32), np.array(values, dtype=np.float32),
+                      np.array(offsets, dtype=np.int64))
+        norms = np.sqrt(np.bincount(self.rows, weights=self.values ** 2, minlength=len(offsets) - 1))
+        self.values /= np.maximum(norms, 1e-9)[self.rows]
+
+    @classmethod
+    def from_arrays(cls, indices, values, offsets):
+        '''
+        Matrix of rows already normalized, as stored by the offline recommendation builder
+        '''
+        feature_matrix = cls.__new__(cls)
+        feature_matrix.set_rows(indices, values, offsets)
+        return feature_matrix
+
+    def set_rows(self, indices, values, offsets):
+        self.indices = indices
+        self.values = values
+        self.offsets = offsets
+        self.rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def to_dense(self, start, end):
+        '''
+        @return - dense float32 array of the rows from start to end
+        '''
+        dense = np.zeros((end - start, feature_dim), dtype=np.float32)
+        begin, finish = self.offsets[start], self.offsets[end]
+        dense[self.rows[begin:finish] - start, self.indices[begin:finish]] = self.values[begin:finish]
+        return dense
+
+    def dot(self, vector):
+        '''
+        @return - array of the dot product of each row with the dense vector
+        '''
+        return np.bincount(self.rows, weights=self.values * vector[self.indices], minlength=len(self.offsets) - 1)
+
+    def add_rows_to(self, vector, row_weights):
+        '''
+        vector += sum of the rows weighted by row_weights, in place
+        '''
+        np.add.at(vector, self.indices, self.values * np.asarray(row_weights, dtype=np.float32)[self.rows])
+
+
+class UserProfile:
+    '''
+    Dense preference vector of a user, updated in place as the user labels articles
+    '''
+    def __init__(self, preferences):
+        '''
+        @param preferences - {'like': [article], 'dislike': [...], 'uncertain': [...]}
+        '''
+        self.vector = np.zeros(feature_dim, dtype=np.float32)
+        self._lock = threading.Lock()
+        article_list = []
+        weights = []
+        for preference, articles in preferences.items():
+            article_list += articles
+            weights += [preference_weights.get(preference, 0.0)] * len(articles)
+        if len(article_list) > 0:
+            FeatureMatrix(article_list).add_rows_to(self.vector, weights)
+
+    def update(self, article, preference, prev_article=None, prev_preference=None):
+        '''
+        Move the article from its previous label to the new one
+        @param prev_article - the article as it was labeled before, its features are the ones to take back
+        '''
+        article_list = [article]
+        weights = [preference_weights.get(preference, 0.0)]
+        if prev_article is not None:
+            article_list.append(prev_article)
+            weights.append(-preference_weights.get(prev_preference, 0.0))
+        with self._lock:
+            FeatureMatrix(article_list).add_rows_to(self.vector, weights)
+
+    def is_empty(self):
+        return not self.vector.any()
+
+    def score(self, feature_matrix):
+        return feature_matrix.dot(self.vector)
@@ -0,0 +1,525 @@
+import argparse
+import fcntl
+import gzip
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import boto3
+import numpy as np
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Full text search over the techcrunch articles
+#
+# The index is a directory of immutable segment files, one written per crawled day,
+# and a manifest listing the live ones. Segments are memory mapped, a query binary
+# searches the sorted term table of each segment and reads the postings in place,
+# then ranks the articles with BM25. When there are more than max_segments the smallest
+# ones are merged, so a corpus going back to 2016 is searched in a handful of segments.
+#
+# $python search_index.py build 2016-01-01 2019-09-30
+# $python search_index.py add-day 2019-09-20
+# $python search_index.py merge
+# $python search_index.py query "electric scooter"
+
+search_index_dir = os.environ.get('NEWSFEED_SEARCH_INDEX', 'search-index')
+article_s3_bucket_name = 'techcrunch-article-set'
+article_s3_bundle_prefix = 'daily/'
+s3_fetch_workers = 16
+build_day_workers = 4
+
+max_segments = 16
+merge_factor = 8
+
+bm25_k1 = 1.2
+bm25_b = 0.75
+# title terms are counted this many times, a title match outweighs a body match
+title_boost = 3
+
+segment_magic = b'TCSEG001'
+# magic, docs, terms, total length, docs json offset and size, term offsets, term blob, posting offsets, postings
+segment_header = struct.Struct('<8sIIQQQQQQQ')
+
+token_pattern = re.compile(r"[a-z0-9]+")
+stop_words = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from', 'has', 'have', 'he',
+    'her', 'his', 'in', 'is', 'it', 'its', 'of', 'on', 'or', 'she', 'that', 'the', 'their', 'they',
+    'this', 'to', 'was', 'we', 'were', 'which', 'will', 'with', 'you'))
+
+def tokenize(text):
+    return [token for token in token_pattern.findall(text.lower()) if token not in stop_words]
+
+
+class Segment:
+    '''
+    Read only view of a memory mapped segment file.
+    Docs are [article_id, title, date 'yyyy-mm-dd', url, length], postings are (doc index, term frequency) pairs.
+    '''
+    def __init__(self, path):
+        self.name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.doc_count, self.term_count, self.total_length, docs_offset, docs_size,
+         term_offsets_offset, terms_offset, posting_offsets_offset, postings_offset) = segment_header.unpack_from(self.mm, 0)
+        if magic != segment_magic:
+            raise ValueError("{} is not a search index segment".format(path))
+
+        view = memoryview(self.mm)
+        self.docs = json.loads(bytes(view[docs_offset:docs_offset + docs_size]).decode('utf-8'))
+        self.term_offsets = view[term_offsets_offset:terms_offset].cast('I')
+        self.terms = view[terms_offset:posting_offsets_offset]
+        self.posting_offsets = view[posting_offsets_offset:postings_offset].cast('Q')
+        self.postings = view[postings_offset:].cast('I')
+        self.doc_lengths = np.array([doc[4] for doc in self.docs], dtype=np.float64)
+
+    def get_live_mask(self, masked):
+        '''
+        @param masked - set of dates re-indexed in newer segments
+        @return - bool array, True for the docs of the dates not masked
+        '''
+        return np.array([doc[2] not in masked for doc in self.docs], dtype=bool)
+
+    def term_at(self, i):
+        return bytes(self.terms[self.term_offsets[i]:self.term_offsets[i + 1]])
+
+    def find_term(self, term):
+        '''
+        @param term - utf-8 encoded term
+        @return - index of the term, or -1 if not in this segment
+        '''
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term_at(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.term_count and self.term_at(lo) == term:
+            return lo
+        return -1
+
+    def get_postings(self, term):
+        '''
+        @return - flat memoryview of doc index, frequency pairs, empty if the term is not in this segment
+        '''
+        i = self.find_term(term)
+        if i < 0:
+            return self.postings[0:0]
+        return self.postings[2 * self.posting_offsets[i]:2 * self.posting_offsets[i + 1]]
+
+    def get_posting_array(self, term):
+        '''
+        @return - (n, 2) uint32 array of doc index, frequency rows read in place from the segment
+        '''
+        postings = self.get_postings(term)
+        if len(postings) == 0:
+            return np.zeros((0, 2), dtype=np.uint32)
+        return np.frombuffer(postings, dtype=np.uint32).reshape(-1, 2)
+
+    def iter_terms(self):
+        '''
+        @return - generator of (utf-8 encoded term, postings)
+        '''
+        for i in range(self.term_count):
+            yield self.term_at(i), self.postings[2 * self.posting_offsets[i]:2 * self.posting_offsets[i + 1]]
+
+
+def write_segment(path, docs, postings):
+    '''
+    Write a segment file, through a temporary file so readers never see a partial one
+    @param docs - list of [article_id, title, date, url, length]
+    @param postings - {utf-8 encoded term: array('I') of doc index, frequency pairs}
+    '''
+    terms = sorted(postings)
+    term_offsets = array('I', [0])
+    posting_offsets = array('Q', [0])
+    all_postings = array('I')
+    for term in terms:
+        term_offsets.append(term_offsets[-1] + len(term))
+        all_postings.extend(postings[term])
+        posting_offsets.append(len(all_postings) // 2)
+    term_blob = b''.join(terms)
+    docs_json = json.dumps(docs).encode('utf-8')
+
+    def padded(size):
+        return (size + 7) // 8 * 8
+    docs_offset = segment_header.size
+    term_offsets_offset = padded(docs_offset + len(docs_json))
+    terms_offset = term_offsets_offset + len(term_offsets) * term_offsets.itemsize
+    posting_offsets_offset = padded(terms_offset + len(term_blob))
+    postings_offset = posting_offsets_offset + len(posting_offsets) * posting_offsets.itemsize
+
+    header = segment_header.pack(
+        segment_magic, len(docs), len(terms), sum(doc[4] for doc in docs), docs_offset, len(docs_json),
+        term_offsets_offset, terms_offset, posting_offsets_offset, postings_offset)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(docs_json)
+        f.write(b'\0' * (term_offsets_offset - docs_offset - len(docs_json)))
+        term_offsets.tofile(f)
+        f.write(term_blob)
+        f.write(b'\0' * (posting_offsets_offset - terms_offset - len(term_blob)))
+        posting_offsets.tofile(f)
+        all_postings.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def index_articles(articles):
+    '''
+    @param articles - list of article dict with 'article_id', 'title', 'date', 'url' and optionally 'text'
+    @return - (docs, postings) as taken by write_segment
+    '''
+    docs = []
+    postings = {}
+    for doc, article in enumerate(articles):
+        tokens = tokenize(article['title']) * title_boost + tokenize(article.get('text') or '')
+        frequencies = {}
+        for token in tokens:
+            frequencies[token] = frequencies.get(token, 0) + 1
+        for token, frequency in frequencies.items():
+            postings.setdefault(token.encode('utf-8'), array('I')).extend((doc, frequency))
+        docs.append([article['article_id'], article['title'], article['date'].replace("/", "-"), article.get('url'), len(tokens)])
+    return docs, postings
+
+
+def load_article_texts(date, article_ids):
+    '''
+    Read the article bodies of a date from the article bucket, from the daily bundle
+    when the scraper wrote one, otherwise one object per article
+    @param date - date string of format yyyy-mm-dd
+    @return - {article_id: text} of the articles found
+    '''
+    s3_client = boto3.client('s3', config=Config(max_pool_connections=s3_fetch_workers))
+
+    texts = {}
+    try:
+        response = s3_client.get_object(Bucket=article_s3_bucket_name, Key=article_s3_bundle_prefix + date + '.jsonl.gz')
+        for line in gzip.decompress(response['Body'].read()).decode('utf-8').splitlines():
+            if line:
+                article = json.loads(line)
+                texts[article['article_id']] = article.get('text') or ''
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+
+    def get_text(article_id):
+        try:
+            response = s3_client.get_object(Bucket=article_s3_bucket_name, Key=article_id + '.json')
+        except ClientError as e:
+            print("[warn] no body for article {}: {}".format(article_id, e.response['Error']['Code']))
+            return article_id, None
+        return article_id, json.loads(response['Body'].read().decode('utf-8')).get('text') or ''
+
+    missing_ids = [article_id for article_id in article_ids if article_id not in texts]
+    with ThreadPoolExecutor(max_workers=s3_fetch_workers) as executor:
+        for article_id, text in executor.map(get_text, missing_ids):
+            if text is not None:
+                texts[article_id] = text
+    return texts
+
+
+class SearchIndex:
+    '''
+    Segmented BM25 index, searched by the web app and updated when a day is crawled.
+    Writers hold an exclusive lock on the index directory, readers pick up the
+    new manifest on their next query.
+    '''
+    def __init__(self, path=search_index_dir, text_loader=load_article_texts):
+        '''
+        @param path - index directory
+        @param text_loader - function(date 'yyyy-mm-dd', article_ids) returning {article_id: text}
+        '''
+        self.path = path
+        self.text_loader = text_loader
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        self.manifest_mtime = None
+        # {segment name: Segment}, [(Segment, live doc mask)] of the current manifest
+        self.open_segments = {}
+        self.live_segments = []
+        # dates of format yyyy-mm-dd indexed in the current manifest, and those indexed without articles
+        self.indexed_days = frozenset()
+        self.empty_days = frozenset()
+        self._lock = threading.Lock()
+
+    # reading
+    def read_manifest(self):
+        '''
+        @return - {'segments': [{'name': str, 'days': [date], 'masked': [date]}], 'empty_days': [date], 'next_id': int}
+        '''
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {'segments': [], 'next_id': 0}
+        manifest.setdefault('empty_days', [])
+        return manifest
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if mtime == self.manifest_mtime:
+                return
+            manifest = self.read_manifest()
+            open_segments = {}
+            live_segments = []
+            indexed_days = set()
+            for entry in manifest['segments']:
+                segment = self.open_segments.get(entry['name']) or Segment(os.path.join(self.path, entry['name']))
+                open_segments[entry['name']] = segment
+                masked = frozenset(entry.get('masked', ()))
+                live_segments.append((segment, segment.get_live_mask(masked) if masked else np.ones(segment.doc_count, dtype=bool)))
+                indexed_days.update(day for day in entry['days'] if day not in masked)
+            self.open_segments = open_segments
+            self.live_segments = live_segments
+            self.indexed_days = frozenset(indexed_days)
+            self.empty_days = frozenset(manifest['empty_days'])
+            self.manifest_mtime = mtime
+
+    def has_day(self, date):
+        '''
+        @param date - date string of format yyyy-mm-dd or yyyy/mm/dd
+        '''
+        self.refresh()
+        return date.replace("/", "-") in self.indexed_days
+
+    def has_empty_day(self, date):
+        '''
+        @param date - date string of format yyyy-mm-dd or yyyy/mm/dd
+        @return - True if the day was indexed when it had no articles
+        '''
+        self.refresh()
+        return date.replace("/", "-") in self.empty_days
+
+    def search(self, query, limit=20):
+        '''
+        @param query - free text query
+        @param limit - max number of results
+        @return - list of {'article_id', 'title', 'date', 'url', 'score'} ranked by BM25 score
+        '''
+        self.refresh()
+        live_segments = self.live_segments
+        terms = [term.encode('utf-8') for term in set(tokenize(query))]
+        if len(terms) == 0 or len(live_segments) == 0:
+            return []
+
+        # docs of masked days are left out of the collection statistics as well as the results
+        doc_count = sum(int(live.sum()) for segment, live in live_segments)
+        average_length = sum(float(segment.doc_lengths[live].sum()) for segment, live in live_segments) / max(doc_count, 1)
+
+        # [(segment, bm25 length norm per doc, score per doc)], scores are added a whole term at a time
+        segment_scores = [(segment, None, None) for segment, live in live_segments]
+        for term in terms:
+            term_postings = []
+            for segment, live in live_segments:
+                postings = segment.get_posting_array(term)
+                term_postings.append(postings[live[postings[:, 0]]])
+            df = sum(len(postings) for postings in term_postings)
+            if df == 0:
+                continue
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            for i, postings in enumerate(term_postings):
+                if len(postings) == 0:
+                    continue
+                segment, norm, scores = segment_scores[i]
+                if scores is None:
+                    norm = bm25_k1 * (1 - bm25_b + bm25_b * segment.doc_lengths / average_length)
+                    scores = np.zeros(segment.doc_count, dtype=np.float64)
+                    segment_scores[i] = (segment, norm, scores)
+                docs = postings[:, 0].astype(np.intp)
+                frequencies = postings[:, 1].astype(np.float64)
+                np.add.at(scores, docs, idf * frequencies * (bm25_k1 + 1) / (frequencies + norm[docs]))
+
+        # the top docs of each segment, then the top of those
+        candidates = []
+        for segment, norm, scores in segment_scores:
+            if scores is None:
+                continue
+            docs = np.flatnonzero(scores)
+            if len(docs) > limit:
+                docs = docs[np.argpartition(scores[docs], -limit)[-limit:]]
+            candidates += [(float(scores[doc]), segment.name, int(doc)) for doc in docs]
+
+        results = []
+        for score, name, doc_index in heapq.nlargest(limit, candidates):
+            article_id, title, date, url, length = self.open_segments[name].docs[doc_index]
+            results.append({'article_id': article_id, 'title': title, 'date': date, 'url': url, 'score': score})
+        return results
+
+    # writing
+    def write_lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = open(os.path.join(self.path, 'index.lock'), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def write_manifest(self, manifest):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def add_day(self, date, article_list, texts=None):
+        '''
+        Index the articles of a day as a new segment, masking the day in older segments
+        @param date - date string of format yyyy-mm-dd
+        @param article_list - list of article dict of the day
+        @param texts - optional {article_id: text}, loaded with text_loader if not given
+        '''
+        date = date.replace("/", "-")
+        if len(article_list) == 0:
+            # recorded so the day is not queued for indexing again on every view
+            with self.write_lock():
+                manifest = self.read_manifest()
+                if date not in manifest['empty_days']:
+                    manifest['empty_days'].append(date)
+                    self.write_manifest(manifest)
+            return
+        if texts is None:
+            texts = self.text_loader(date, [article['article_id'] for article in article_list])
+        articles = [dict(article, text=texts.get(article['article_id'], '')) for article in article_list]
+        docs, postings = index_articles(articles)
+
+        with self.write_lock():
+            manifest = self.read_manifest()
+            name = 'segment-{:08d}.idx'.format(manifest['next_id'])
+            manifest['next_id'] += 1
+            write_segment(os.path.join(self.path, name), docs, postings)
+            for entry in manifest['segments']:
+                if date in entry['days'] and date not in entry.get('masked', []):
+                    entry.setdefault('masked', []).append(date)
+            manifest['segments'].append({'name': name, 'days': [date], 'masked': []})
+            if date in manifest['empty_days']:
+                manifest['empty_days'].remove(date)
+            obsolete = self.merge_segments(manifest)
+            self.write_manifest(manifest)
+            self.remove_segments(obsolete)
+        print("indexed {} articles of {} into {}".format(len(docs), date, name))
+
+    def merge_segments(self, manifest, force=False):
+        '''
+        Merge the smallest segments while there are more than max_segments, or all of them if force.
+        Called with the write lock held, the caller writes the manifest.
+        @return - names of the merged segments, to remove once the manifest is written
+        '''
+        obsolete = []
+        while len(manifest['segments']) > (1 if force else max_segments):
+            entries = sorted(manifest['segments'], key=lambda entry: os.path.getsize(os.path.join(self.path, entry['name'])))
+            merged_entries = entries if force else entries[:merge_factor]
+
+            docs = []
+            postings = {}
+            for entry in merged_entries:
+                segment = Segment(os.path.join(self.path, entry['name']))
+                masked = set(entry.get('masked', []))
+                # old doc index -> new doc index, None for masked docs
+                remap = []
+                for doc in segment.docs:
+                    if doc[2] in masked:
+                        remap.append(None)
+                    else:
+                        remap.append(len(docs))
+                        docs.append(doc)
+                for term, term_postings in segment.iter_terms():
+                    merged = postings.setdefault(term, array('I'))
+                    for i in range(0, len(term_postings), 2):
+                        doc = remap[term_postings[i]]
+                        if doc is not None:
+                            merged.extend((doc, term_postings[i + 1]))
+                obsolete.append(entry['name'])
+
+            postings = {term: term_postings for term, term_postings in postings.items() if len(term_postings) > 0}
+            name = 'segment-{:08d}.idx'.format(manifest['next_id'])
+            manifest['next_id'] += 1
+            write_segment(os.path.join(self.path, name), docs, postings)
+            days = sorted(set(day for entry in merged_entries for day in entry['days'] if day not in entry.get('masked', [])))
+            merged_names = set(entry['name'] for entry in merged_entries)
+            manifest['segments'] = [entry for entry in manifest['segments'] if entry['name'] not in merged_names]
+            manifest['segments'].append({'name': name, 'days': days, 'masked': []})
+            if force:
+                break
+        return obsolete
+
+    def merge(self):
+        '''
+        Merge all segments into one
+        '''
+        with self.write_lock():
+            manifest = self.read_manifest()
+            if len(manifest['segments']) > 1:
+                obsolete = self.merge_segments(manifest, force=True)
+                self.write_manifest(manifest)
+                self.remove_segments(obsolete)
+
+    def remove_segments(self, names):
+        # readers still mapping a removed segment keep it alive until their next refresh
+        for name in names:
+            os.remove(os.path.join(self.path, name))
+
+
+def build_index(index, article_db, start, end):
+    '''
+    Index every day from start to end inclusive, article lists are read from the article db
+    in one concurrent batch and the bodies of several days are loaded at once
+    @param start - date string of format yyyy-mm-dd
+    @param end - date string of format yyyy-mm-dd
+    '''
+    start_date = datetime.strptime(start, "%Y-%m-%d")
+    end_date = datetime.strptime(end, "%Y-%m-%d")
+    dates = [(start_date + timedelta(days=day)).strftime("%Y/%m/%d") for day in range((end_date - start_date).days + 1)]
+
+    def load_day(day):
+        date, article_list = day
+        date = date.replace("/", "-")
+        if len(article_list) == 0:
+            return date, article_list, {}
+        return date, article_list, index.text_loader(date, [article['article_id'] for article in article_list])
+
+    with ThreadPoolExecutor(max_workers=build_day_workers) as executor:
+        for date, article_list, texts in executor.map(load_day, article_db.iter_articles_by_dates(dates)):
+            index.add_day(date, article_list, texts)
+
+if __name__ == '__main__':
+    from storage import create_storage
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index', default=search_index_dir, help='index directory')
+    commands = parser.add_subparsers(dest='command')
+    build_parser = commands.add_parser('build', help='index a range of days')
+    build_parser.add_argument('start', help='yyyy-mm-dd')
+    build_parser.add_argument('end', help='yyyy-mm-dd')
+    add_day_parser = commands.add_parser('add-day', help='index or re-index a day')
+    add_day_parser.add_argument('date', help='yyyy-mm-dd')
+    commands.add_parser('merge', help='merge all segments into one')
+    query_parser = commands.add_parser('query', help='run a query')
+    query_parser.add_argument('query')
+    query_parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    index = SearchIndex(args.index)
+    if args.command == 'build':
+        build_index(index, create_storage()[0], args.start, args.end)
+    elif args.command == 'add-day':
+        index.add_day(args.date, create_storage()[0].get_articles_by_date(args.date.replace("-", "/")))
+    elif args.command == 'merge':
+        index.merge()
+    elif args.command == 'query':
+        start_time = datetime.now()
+        results = index.search(args.query, args.limit)
+        print("{} results in {:.2f} ms".format(len(results), (datetime.now() - start_time).total_seconds() * 1000))
+        for result in results:
+            print("{:>8.3f} {} {}".format(result['score'], result['date'], result['title']))
+    else:
+        parser.print_help()
@@ -0,0 +1,157 @@
+import os
+
+# Storage backends of the web app
+#   dynamodb - aws_gateway.AWS_Article_DB / AWS_Pref_DB (default)
+#   sqlite   - local_gateway.SQLite_Article_DB / SQLite_Pref_DB, for running the app
+#              and its load tests locally without AWS
+storage_backend = os.environ.get('NEWSFEED_STORAGE', 'dynamodb')
+sqlite_path = os.environ.get('NEWSFEED_SQLITE_PATH', 'newsfeed.sqlite3')
+
+def normalize_entity(entity):
+    '''
+    Entities are indexed lower cased with single spaces, as text-processor/article-retriever.py writes them
+    '''
+    return ' '.join(entity.lower().split())
+
+
+class Article_DB:
+    '''
+    Interface of the article metadata store.
+    Articles are dict of {'article_id', 'title', 'date' (yyyy/mm/dd), 'url'}
+    '''
+    # True when the scraper lambda fills the store and keeps the article bodies in s3,
+    # so missing dates can be crawled and article bodies can be searched
+    has_scraper = False
+
+    def put_single_article(self, article):
+        raise NotImplementedError
+
+    def put_articles(self, article_list):
+        raise NotImplementedError
+
+    def get_articles_by_date(self, date, attributes=None):
+        '''
+        @ date - date string of formate yyyy/MM/dd
+        @ attributes - names of the attributes to return, all attributes if None
+        @ return - list of article dict, empty if none
+        '''
+        raise NotImplementedError
+
+    def iter_articles_by_dates(self, dates, attributes=None):
+        '''
+        @ dates - list of date strings of formate yyyy/MM/dd
+        @ return - generator of (date, list of article dict), ordered as the dates
+        '''
+        for date in dates:
+            yield date, self.get_articles_by_date(date, attributes)
+
+    def get_articles_by_dates(self, dates, attributes=None):
+        '''
+        @ dates - list of date strings of formate yyyy/MM/dd
+        @ return - list of article dict, ordered as the dates
+        '''
+        article_list = []
+        for date, date_articles in self.iter_articles_by_dates(dates, attributes):
+            article_list += date_articles
+        return article_list
+
+    def get_articles_by_ids(self, keys, attributes=None):
+        '''
+        @ keys - list of {'date': 'yyyy/MM/dd', 'article_id': str}
+        @ return - list of article dict in the order of the keys, missing articles are left out
+        '''
+        article_list = []
+        for key in keys:
+            article = self.get_article_by_id(key['article_id'])
+            if article:
+                article_list.append(article)
+        return article_list
+
+    def get_article_by_id(self, article_id):
+        '''
+        @ return - article dict, or empty list if not found
+        '''
+        raise NotImplementedError
+
+    def get_articles_by_entity(self, entity, limit=100):
+        '''
+        @ entity - entity name, matched case insensitively
+        @ return - list of article dict mentioning the entity, newest first,
+                   with 'sentiment' set to the article sentiment label if analyzed
+        '''
+        raise NotImplementedError
+
+    def get_sentiment_rollup(self, date):
+        '''
+        @ date - date string of formate yyyy/MM/dd
+        @ return - {sentiment label: list of article dict} of the analyzed articles of the date
+        '''
+        raise NotImplementedError
+
+    def put_article_analysis(self, article_list):
+        '''
+        Index analyzed articles by entity and sentiment, replacing what they were indexed under before.
+        On dynamodb the index is written by text-processor/article-retriever.py along with the analysis
+        @ article_list - article dict with 'sentiment' ({'Sentiment': label, ...}) and 'entities' (list of str)
+        '''
+        raise NotImplementedError
+
+    def validate_article(self, article):
+        assert article['article_id'] is not None
+        assert article['date'] is not None
+        assert article['title'] is not None
+        assert article['url'] is not None
+
+
+class Pref_DB:
+    '''
+    Interface of the user article preference store.
+    One preference per (user_id, article_id), preference is 'like', 'dislike' or 'uncertain'
+    '''
+    def record_single_preference(self, user_id, article, preference):
+        self.put_article_preference(user_id, article, preference)
+
+    def record_preference(self, user_id, liked_article, dislike_article, uncertain_article):
+        liked_articles = [liked_article] if liked_article else []
+        dislike_articles = [dislike_article] if dislike_article else []
+        uncertain_articles = [uncertain_article] if uncertain_article else []
+        self.record_preference_list(user_id, liked_articles, dislike_articles, uncertain_articles)
+
+    def record_preference_list(self, user_id, liked_articles, dislike_articles, uncertain_articles):
+        raise NotImplementedError
+
+    def get_all_articles(self, user_id):
+        '''
+        @ return - {'like': {article_id: article}, 'dislike': {...}, 'uncertain': {...}}
+        '''
+        raise NotImplementedError
+
+    def get_articles_by_preference(self, user_id, preference):
+        raise NotImplementedError
+
+    def put_article_preference(self, user_id, article, preference):
+        raise NotImplementedError
+
+    def get_recommendations(self, user_id):
+        '''
+        @ return - list of recommended article dict, best first, precomputed by
+                   text-processor/recommendation-builder.py, empty if not built yet
+        '''
+        raise NotImplementedError
+
+
+def create_storage(backend=None):
+    '''
+    @param backend - 'dynamodb' or 'sqlite', defaults to the NEWSFEED_STORAGE env variable
+    @return - (article db, user preference db),
+              article_db.has_scraper tells whether the backend can crawl missing dates and load article bodies
+    '''
+    backend = backend or storage_backend
+    if backend == 'sqlite':
+        from local_gateway import SQLite_Article_DB, SQLite_Pref_DB, connect
+        connection = connect(sqlite_path)
+        return SQLite_Article_DB(connection), SQLite_Pref_DB(connection)
+    if backend == 'dynamodb':
+        from aws_gateway import AWS_Article_DB, AWS_Pref_DB
+        return AWS_Article_DB(), AWS_Pref_DB()
+    raise ValueError("unknown storage backend: {}".format(backend))
@@ -0,0 +1,78 @@
+# Measure cold vs warm invoke latency of the deployed scraper
+#
+# $python benchmark.py 2019-09-20 --warm 5
+#
+# The first invoke runs on a fresh container (the function configuration is touched
+# beforehand to retire the warm ones), the following ones reuse the warm container.
+# Latency is reported from the client side and from the REPORT line of the lambda log.
+# The invokes are dry runs, the scraper crawls and parses the day but writes nothing to
+# s3 or dynamodb, sends no notification and does not invoke the analyzer.
+
+import argparse
+import base64
+import json
+import re
+import time
+import boto3
+from botocore.config import Config
+
+region_name = 'us-east-1'
+lambda_func_name = 'daily-article-dev-scraper'
+
+lambda_client = boto3.client('lambda', region_name=region_name, config=Config(read_timeout=15 * 60))
+
+def force_cold_start():
+    '''
+    Any configuration update retires the warm containers of the function
+    '''
+    config = lambda_client.get_function_configuration(FunctionName=lambda_func_name)
+    variables = config.get('Environment', {}).get('Variables', {})
+    variables['benchmark_timestamp'] = str(time.time())
+    lambda_client.update_function_configuration(
+        FunctionName=lambda_func_name,
+        Environment={'Variables': variables})
+    # wait for the update to be applied
+    time.sleep(10)
+
+def invoke(date_str):
+    '''
+    @return - {'client_ms': float, 'duration_ms': float, 'billed_ms': float, 'init_ms': float or None}
+    '''
+    start_time = time.time()
+    response = lambda_client.invoke(
+        FunctionName=lambda_func_name,
+        InvocationType='RequestResponse',
+        LogType='Tail',
+        Payload=json.dumps({'date': date_str, 'test': True, 'dry_run': True}))
+    client_ms = (time.time() - start_time) * 1000
+    response['Payload'].read()
+
+    log = base64.b64decode(response['LogResult']).decode('utf-8')
+    duration = re.search(r'\tDuration: ([\d.]+) ms', log)
+    billed = re.search(r'Billed Duration: ([\d.]+) ms', log)
+    init = re.search(r'Init Duration: ([\d.]+) ms', log)
+    return {
+        'client_ms': client_ms,
+        'duration_ms': float(duration.group(1)) if duration else None,
+        'billed_ms': float(billed.group(1)) if billed else None,
+        'init_ms': float(init.group(1)) if init else None
+    }
+
+def print_result(label, result):
+    print("{:>6}: client {:>9.1f} ms, duration {:>9} ms, billed duration {:>9} ms, init {} ms".format(
+        label, result['client_ms'], result['duration_ms'], result['billed_ms'], result['init_ms']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('date', help='date to crawl, yyyy-mm-dd')
+    parser.add_argument('--warm', type=int, default=3, help='number of warm invokes')
+    args = parser.parse_args()
+
+    force_cold_start()
+    print_result('cold', invoke(args.date))
+
+    warm_results = [invoke(args.date) for _ in range(args.warm)]
+    for result in warm_results:
+        print_result('warm', result)
+    print("mean warm client latency {:.1f} ms".format(
+        sum(result['client_ms'] for result in warm_results) / max(1, len(warm_results))))
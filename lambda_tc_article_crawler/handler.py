@@ -2,14 +2,26 @@ import os
 import subprocess
 import json
 import hashlib
+import gzip
+import io
+import re
+import zlib
+import multiprocessing
+import random
+import time
 import boto3
 import botocore
+import numpy as np
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import scrapy
-from scrapy import signals
+from scrapy.exceptions import DropItem
 from scrapy.crawler import CrawlerProcess, Crawler, CrawlerRunner
 from scrapy.utils.project import get_project_settings
-from scrapy.signalmanager import dispatcher
+from twisted.internet.defer import DeferredList
+from twisted.internet.threads import deferToThread
 
 # https://docs.aws.amazon.com/lambda/latest/dg/lambda-python-how-to-create-deployment-package.html
 # https://nervous.io/python/aws/lambda/2016/02/17/scipy-pandas-lambda/
@@ -27,10 +39,48 @@ success_notification_sns_arn = 'arn:aws:sns:us-east-1:672834257724:Daily-Article
 test_notification_sns_arn = 'arn:aws:sns:us-east-1:672834257724:Daily-Article-Fetch-Notification-Test'
 
 sns = boto3.client('sns', region_name=region_name)
-s3 = boto3.resource('s3')
-db = boto3.resource('dynamodb', region_name=region_name)
-table = db.Table(article_dynamodb_table_name)
-lambda_client = boto3.client('lambda', region_name=region_name)
+sqs = boto3.client('sqs', region_name=region_name)
+
+# range crawl metadata
+checkpoint_prefix = 'crawl-checkpoints/'
+max_resume_attempts = 3
+crawl_time_margin_sec = 60
+
+# s3 upload stage metadata
+s3_upload_workers = 16
+s3_upload_max_attempts = 5
+s3_upload_backoff_sec = 0.2
+s3_bundle_prefix = 'daily/'
+
+# item pipeline metadata
+article_batch_size = 10
+
+# near-duplicate filter metadata
+# minhash signatures of the stored articles are kept per day in s3, and a crawl checks
+# its articles against the days of the crawl and the dedup_history_days before it.
+# 16 bands of 8 rows make articles above ~0.7 jaccard similarity collide in some band.
+minhash_prefix = 'minhash/'
+minhash_permutations = 128
+lsh_bands = 16
+shingle_size = 5
+duplicate_jaccard_threshold = 0.8
+dedup_history_days = 7
+
+def create_aws_clients():
+    '''
+    (Re)create the module level aws clients used while crawling.
+    Called again in every crawl child process, so that a child never
+    shares a pooled connection with the warm parent process.
+    '''
+    global s3, db, table, lambda_client, s3_client
+    s3 = boto3.resource('s3')
+    db = boto3.resource('dynamodb', region_name=region_name)
+    table = db.Table(article_dynamodb_table_name)
+    lambda_client = boto3.client('lambda', region_name=region_name)
+    # one client shared by all upload threads, with a connection per worker
+    s3_client = boto3.client('s3', region_name=region_name, config=Config(max_pool_connections=s3_upload_workers))
+
+create_aws_clients()
 
 def getTitleHash(title):
   '''
@@ -41,10 +91,13 @@ def getTitleHash(title):
   '''
   return hashlib.sha256(title.encode().strip().lower()).hexdigest()
 
+# sent by TechCrunchSpider once every request of a day has been handled
+day_completed = object()
+
 class TechCrunchSpider(scrapy.Spider):
     name = "techcrunch"
 
-    def __init__(self, date='', start='', end='', **kwargs):
+    def __init__(self, date='', start='', end='', skip_dates=None, **kwargs):
         if len(date) > 0:
             self.start_date = datetime.strptime(date, '%Y-%m-%d')
             self.end_date = self.start_date
@@ -52,18 +105,26 @@ class TechCrunchSpider(scrapy.Spider):
             self.start_date = datetime.strptime(start, '%Y-%m-%d')
             self.end_date = datetime.strptime(end, '%Y-%m-%d')
         else:
-            self.start_date = datetime.today().strftime('%Y-%m-%d')
+            self.start_date = datetime.strptime(datetime.today().strftime('%Y-%m-%d'), '%Y-%m-%d')
             self.end_date = self.start_date
+        # days already stored by a previous invocation, 'yyyy-mm-dd'
+        self.skip_dates = set(skip_dates or [])
+        # number of requests not yet handled per day, 'yyyy-mm-dd' -> int
+        self.pending_requests = {}
+        # archive pages fetched and article links found per day, 'yyyy-mm-dd' -> dict
+        self.day_stats = {}
+        self.seen_urls = set()
         super().__init__(**kwargs)
 
     def start_requests(self):        
         curr_date = self.start_date
         
         while curr_date <= self.end_date:
-            new_request = scrapy.Request(self.generate_url(curr_date))
-            new_request.meta["date"] = curr_date
-            new_request.meta["page_number"] = 1
-            yield new_request
+            if curr_date.strftime('%Y-%m-%d') not in self.skip_dates:
+                new_request = self.make_day_request(self.generate_url(curr_date), curr_date, self.parse)
+                if new_request:
+                    new_request.meta["page_number"] = 1
+                    yield new_request
             curr_date += timedelta(days=1)
 
     def generate_url(self, date, page_number=None):
@@ -72,26 +133,69 @@ class TechCrunchSpider(scrapy.Spider):
             url  += "page/" + str(page_number) + "/"
         return url
 
+    def make_day_request(self, url, date, callback):
+        '''
+        Build a request counted in the pending requests of its day.
+        Duplicated urls are skipped here rather than by the scrapy dupe filter,
+        as a silently filtered request would keep its day from ever completing.
+        @return - scrapy.Request, or None if url has been requested already
+        '''
+        if url in self.seen_urls:
+            return None
+        self.seen_urls.add(url)
+        day = date.strftime('%Y-%m-%d')
+        self.pending_requests[day] = self.pending_requests.get(day, 0) + 1
+        request = scrapy.Request(url, callback=callback, errback=self.request_failed, dont_filter=True)
+        request.meta['date'] = date
+        return request
+
+    def request_done(self, date):
+        day = date.strftime('%Y-%m-%d')
+        self.pending_requests[day] -= 1
+        if self.pending_requests[day] == 0:
+            del self.pending_requests[day]
+            stats = self.get_day_stats(day)
+            self.logger.info("finished crawling day %s, %d pages fetched, %d articles found",
+                             day, stats['pages'], stats['articles'])
+            self.crawler.signals.send_catch_log(signal=day_completed, spider=self, date=day)
+
+    def request_failed(self, failure):
+        # when I access a page number that doesn't exist I get 404, which ends up here
+        self.logger.info("request failed: %s", failure.request.url)
+        self.request_done(failure.request.meta['date'])
+
+    def get_day_stats(self, day):
+        return self.day_stats.setdefault(day, {'pages': 0, 'articles': 0})
+
     def parse(self, response):
         date = response.meta['date']
         page_number = response.meta['page_number']
 
-        # when I access a page number that doesn't exist I get 404
-        # I could use the pagination buttons, but this is less work
-        if response.status == 200:
-            articles = response.xpath('//h2[@class="post-block__title"]/a/@href').extract()
-            for url in articles:
-                request = scrapy.Request(url,
-                                callback=self.parse_article)
-                request.meta['date'] = date
-                yield request
-
-            url = self.generate_url(date, page_number+1)
-            request = scrapy.Request(url,
-                            callback=self.parse)
-            request.meta['date'] = date
-            request.meta['page_number'] = page_number
-            yield request
+        try:
+            if response.status == 200:
+                articles = response.xpath('//h2[@class="post-block__title"]/a/@href').extract()
+                stats = self.get_day_stats(date.strftime('%Y-%m-%d'))
+                stats['pages'] += 1
+                stats['articles'] += len(articles)
+                self.crawler.stats.inc_value('techcrunch/pages_fetched')
+                self.crawler.stats.inc_value('techcrunch/articles_found', len(articles))
+
+                for url in articles:
+                    request = self.make_day_request(url, date, self.parse_article)
+                    if request:
+                        yield request
+
+                # an archive page without article links is past the last page of the day
+                if len(articles) == 0:
+                    return
+
+                url = self.generate_url(date, page_number+1)
+                request = self.make_day_request(url, date, self.parse)
+                if request:
+                    request.meta['page_number'] = page_number+1
+                    yield request
+        finally:
+            self.request_done(date)
 
     def parse_article(self, response):
         item = {
@@ -100,34 +204,515 @@ class TechCrunchSpider(scrapy.Spider):
             'date': response.meta['date'].strftime("%Y/%m/%d"),
             'url' : response.url
         }
-        yield item
+        try:
+            yield item
+        finally:
+            # scrapy resumes this generator only after the item went through the item signals
+            self.request_done(response.meta['date'])
 
-def lambda_handler(event, context):
-    # list to collect all items
-    items = []
-    def add_item(item):
-        items.append(item)
+# hash family of the minhash signatures, fixed as signatures are persisted across crawls
+minhash_rand = np.random.RandomState(20190920)
+minhash_a = minhash_rand.randint(1, 2 ** 63, size=minhash_permutations, dtype=np.uint64) | np.uint64(1)
+minhash_b = minhash_rand.randint(0, 2 ** 63, size=minhash_permutations, dtype=np.uint64)
+token_pattern = re.compile(r"[a-z0-9]+")
 
-    try:
-        # crawl article on the given date
-        dateStr = None
+def get_minhash(text):
+    '''
+    @param text - article body
+    @return - uint32 array of minhash_permutations minimums over the word shingles of the text,
+              None if the text has no words
+    '''
+    tokens = token_pattern.findall(text.lower())
+    if len(tokens) == 0:
+        return None
+    shingles = {' '.join(tokens[i:i + shingle_size]) for i in range(max(1, len(tokens) - shingle_size + 1))}
+    hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+    # multiply-shift hashing, uint64 products wrap around
+    permuted = (hashes[:, None] * minhash_a + minhash_b) >> np.uint64(32)
+    return permuted.min(axis=0).astype(np.uint32)
+
+class MinHashIndex:
+    '''
+    LSH index of minhash signatures, two signatures sharing all rows of a band land in the same bucket
+    '''
+    def __init__(self):
+        # (band, band bytes) -> list of article_id
+        self.buckets = {}
+        # article_id -> signature
+        self.signatures = {}
+
+    def get_band_keys(self, signature):
+        rows = minhash_permutations // lsh_bands
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(lsh_bands)]
+
+    def add(self, article_id, signature):
+        if article_id in self.signatures:
+            return
+        self.signatures[article_id] = signature
+        for key in self.get_band_keys(signature):
+            self.buckets.setdefault(key, []).append(article_id)
+
+    def find_duplicate(self, article_id, signature):
+        '''
+        @return - (article_id, estimated jaccard similarity) of the most similar other article
+                  at or above duplicate_jaccard_threshold, (None, 0) if there is none
+        '''
+        best_id, best_similarity = None, 0.0
+        candidates = {other for key in self.get_band_keys(signature) for other in self.buckets.get(key, [])}
+        # an article crawled again keeps its id and is simply overwritten
+        candidates.discard(article_id)
+        for other in candidates:
+            similarity = float(np.mean(self.signatures[other] == signature))
+            if similarity >= duplicate_jaccard_threshold and similarity > best_similarity:
+                best_id, best_similarity = other, similarity
+        return best_id, best_similarity
+
+class DuplicateFilterPipeline:
+    '''
+    Scrapy item pipeline dropping near-duplicates of recently stored articles, placed before
+    ArticleStoragePipeline, so a retitled or syndicated article is neither put into s3 and
+    dynamodb nor sent to the analyzer.
+    Articles are compared by minhash over the word shingles of their text, through an LSH index
+    loaded from the per-day signature files of the crawl days and the days before them.
+    The signatures of the kept articles are written back when the spider closes, unless dry_run.
+    '''
+    def __init__(self, history_days=dedup_history_days, dry_run=False):
+        self.history_days = history_days
+        self.dry_run = dry_run
+        self.index = MinHashIndex()
+        # 'yyyy-mm-dd' -> {article_id: signature} of the signature file of the day
+        self.day_signatures = {}
+        self.changed_days = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(history_days=crawler.settings.getint('DEDUP_HISTORY_DAYS', dedup_history_days),
+                   dry_run=crawler.settings.getbool('ARTICLE_DRY_RUN'))
+
+    def open_spider(self, spider):
+        days = []
+        curr_date = spider.start_date - timedelta(days=self.history_days)
+        while curr_date <= spider.end_date:
+            days.append(curr_date.strftime('%Y-%m-%d'))
+            curr_date += timedelta(days=1)
+        with ThreadPoolExecutor(max_workers=s3_upload_workers) as executor:
+            for day, signatures in zip(days, executor.map(self.load_signatures, days)):
+                self.day_signatures[day] = signatures
+                for article_id, signature in signatures.items():
+                    self.index.add(article_id, signature)
+        print("[info] loaded {} article signatures of {} days".format(len(self.index.signatures), len(days)))
+
+    def process_item(self, item, spider):
+        signature = get_minhash(item['text'])
+        if signature is None:
+            return item
+        article_id = getTitleHash(item['title'])
+        duplicate_id, similarity = self.index.find_duplicate(article_id, signature)
+        if duplicate_id is not None:
+            spider.crawler.stats.inc_value('techcrunch/duplicates_dropped')
+            raise DropItem("near-duplicate ({:.2f}) of article {}: {}".format(similarity, duplicate_id, item['url']))
+        self.index.add(article_id, signature)
+        day = item['date'].replace('/', '-')
+        self.day_signatures.setdefault(day, {})[article_id] = signature
+        self.changed_days.add(day)
+        return item
+
+    def close_spider(self, spider):
+        if self.dry_run:
+            return None
+        return deferToThread(self.save_all)
+
+    def save_all(self):
+        for day in sorted(self.changed_days):
+            self.save_signatures(day, self.day_signatures[day])
+
+    def load_signatures(self, day):
+        '''
+        @return - {article_id: signature} of the day, empty if the day has no signature file
+        '''
         try:
-            dateStr = os.environ['date']
-            datetime.strptime(dateStr, "%Y-%m-%d")
-        except (ValueError, KeyError) as err:
-            print("[error] cannot parse date from env variable!")
-            print(err)
-            dateStr = datetime.today().strftime("%Y-%m-%d")
+            body = s3_client.get_object(Bucket=article_s3_bucket_name, Key=minhash_prefix + day + '.npz')['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            return {}
+        data = np.load(io.BytesIO(body))
+        return {str(article_id): signature for article_id, signature in zip(data['article_ids'], data['signatures'])}
+
+    def save_signatures(self, day, signatures):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer,
+                            article_ids=np.array(list(signatures.keys())),
+                            signatures=np.array(list(signatures.values()), dtype=np.uint32))
+        s3_client.put_object(Bucket=article_s3_bucket_name, Key=minhash_prefix + day + '.npz', Body=buffer.getvalue())
+
+class CrawlCheckpoint:
+    '''
+    Days of a date range crawl which are already stored, kept in s3
+    so that invoking the same range again resumes where the last invocation stopped
+    '''
+    def __init__(self, start, end):
+        self.key = checkpoint_prefix + '{}_{}.json'.format(start, end)
+        self.completed = set()
+
+    def load(self):
+        try:
+            body = s3.Object(article_s3_bucket_name, self.key).get()['Body'].read()
+            self.completed = set(json.loads(body.decode('utf-8'))['completed'])
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+        return self.completed
+
+    def mark_completed(self, date):
+        self.completed.add(date)
+        s3.Object(article_s3_bucket_name, self.key).put(
+            Body=json.dumps({'completed': sorted(self.completed)}))
+
+    def clear(self):
+        s3.Object(article_s3_bucket_name, self.key).delete()
+
+class ArticleUploader:
+    '''
+    Puts articles into the article bucket from a bounded thread pool, retrying with backoff.
+    In compressed mode the articles of a day are packed into a single object of
+    concatenated gzip members, one JSON line per member, and the byte offset and length
+    of each member are recorded in a sidecar index object, so one article can still be
+    read alone with a ranged get.
+    '''
+    def __init__(self, max_workers=s3_upload_workers, compressed=False):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.compressed = compressed
+
+    def upload(self, items):
+        '''
+        @param items - article dict with 'article_id' set, all published on the same date in compressed mode
+        '''
+        if len(items) == 0:
+            return
+        if self.compressed:
+            self.upload_bundle(items)
+        else:
+            # list() waits for every put and raises the first failure
+            list(self.executor.map(self.put_article, items))
+
+    def put_article(self, article):
+        self.put_object(article['article_id'] + '.json', json.dumps(article).encode('utf-8'))
+
+    def upload_bundle(self, items):
+        date = items[0]['date'].replace('/', '-')
+        bundle_key = s3_bundle_prefix + date + '.jsonl.gz'
+        index = {'key': bundle_key, 'articles': {}}
+        members = []
+        offset = 0
+        for article in items:
+            member = gzip.compress((json.dumps(article) + '\n').encode('utf-8'))
+            index['articles'][article['article_id']] = {'offset': offset, 'length': len(member)}
+            members.append(member)
+            offset += len(member)
+
+        print("putting {} articles into s3 bundle {} ({} bytes)".format(len(items), bundle_key, offset))
+        self.put_object(bundle_key, b''.join(members), ContentType='application/gzip')
+        self.put_object(s3_bundle_prefix + date + '.index.json', json.dumps(index).encode('utf-8'))
+
+    def put_object(self, key, body, **kwargs):
+        for attempt in range(s3_upload_max_attempts):
+            try:
+                return s3_client.put_object(Bucket=article_s3_bucket_name, Key=key, Body=body, **kwargs)
+            except ClientError as e:
+                if attempt == s3_upload_max_attempts - 1:
+                    raise
+                # exponential backoff with full jitter
+                delay = random.uniform(0, s3_upload_backoff_sec * (2 ** attempt))
+                print("[warn] put {} failed ({}), retrying in {:.2f}s".format(
+                    key, e.response['Error']['Code'], delay))
+                time.sleep(delay)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+class ArticleStoragePipeline:
+    '''
+    Scrapy item pipeline storing articles while the crawl is still running.
+    Each item gets its title hash as article_id and is buffered per day, every
+    ARTICLE_BATCH_SIZE items are written to s3 and dynamodb from a twisted worker thread.
+    Once a day is completed and all its batches are written, the day is checkpointed and
+    the analyzer is invoked with its article_ids. Downstream of this pipeline items only
+    carry their metadata, the article text is dropped once written.
+    In compressed mode a day is written as a single s3 bundle when the day completes.
+    In dry run mode nothing is written, checkpointed or sent to the analyzer, the items are only counted.
+    '''
+    def __init__(self, batch_size=article_batch_size, compressed=False, dry_run=False):
+        self.batch_size = batch_size
+        self.compressed = compressed
+        self.dry_run = dry_run
+        # 'yyyy-mm-dd' -> list of article dict waiting to be written
+        self.buffers = {}
+        # 'yyyy-mm-dd' -> list of deferred batch writes
+        self.pending_writes = {}
+        # 'yyyy-mm-dd' -> list of article_id
+        self.day_ids = {}
+        self.finishing = []
+        # {'article_id', 'title', 'date', 'url'} of every stored article
+        self.stored = []
+        # 'yyyy-mm-dd' of the days with a failed s3 or dynamodb write
+        self.failed_days = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(
+            batch_size=crawler.settings.getint('ARTICLE_BATCH_SIZE', article_batch_size),
+            compressed=crawler.settings.getbool('ARTICLE_COMPRESSED'),
+            dry_run=crawler.settings.getbool('ARTICLE_DRY_RUN'))
+        crawler.signals.connect(pipeline.day_completed, signal=day_completed)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.uploader = ArticleUploader(compressed=self.compressed)
+        self.checkpoint = getattr(spider, 'checkpoint', None)
+        spider.stored_articles = self.stored
+        spider.failed_days = self.failed_days
+
+    def process_item(self, item, spider):
+        item['article_id'] = getTitleHash(item['title'])
+        day = item['date'].replace('/', '-')
+        self.day_ids.setdefault(day, []).append(item['article_id'])
+
+        buffer = self.buffers.setdefault(day, [])
+        buffer.append(item)
+        if not self.compressed and len(buffer) >= self.batch_size:
+            self.flush(day)
+
+        return get_article_metadata(item)
+
+    def flush(self, day):
+        items = self.buffers.pop(day, [])
+        if len(items) > 0:
+            self.pending_writes.setdefault(day, []).append(deferToThread(self.store, items))
+
+    def day_completed(self, date):
+        self.flush(date)
+        self.finishing.append(self.finish_day(date, checkpoint=True))
+
+    def finish_day(self, date, checkpoint):
+        '''
+        @return - deferred fired once every batch of the day is written and the day is finished
+        '''
+        writes = DeferredList(self.pending_writes.pop(date, []), fireOnOneErrback=True, consumeErrors=True)
+        day_ids = self.day_ids.pop(date, [])
+        d = writes.addCallback(lambda _: deferToThread(self.finished_day, date, day_ids, checkpoint))
+        d.addErrback(self.failed_day, date)
+        return d
+
+    def failed_day(self, failure, date):
+        # the day is not checkpointed, and the crawl result reports it so that the invocation fails
+        print("[error] failed to store articles for {}: {}".format(date, failure.value))
+        self.failed_days.append(date)
+
+    def finished_day(self, date, article_ids, checkpoint):
+        if self.dry_run:
+            print("[info] dry run, {} articles for {} not stored".format(len(article_ids), date))
+            return
+        print("[info] stored {} articles for {}".format(len(article_ids), date))
+        if len(article_ids) > 0:
+            # Invoke the Article Analyzer Lambda (for Sentiment and Entities)
+            print("Invoking daily-article-analyzer lambda func with article_ids")
+            lambda_client.invoke(
+                FunctionName='daily-article-analyzer',
+                InvocationType='Event',
+                LogType='None',
+                Payload=json.dumps({
+                    'article_ids': article_ids, 
+                    # compressed crawls only write the daily bundle, which is found by date
+                    'date': date.replace('-', '/'),
+                    'request_timestamp': 'timestamp'
+                }))
+        if checkpoint and self.checkpoint is not None:
+            self.checkpoint.mark_completed(date)
+
+    def close_spider(self, spider):
+        # days which never completed (crawl closed early) are stored without being checkpointed
+        for date in list(self.buffers.keys()):
+            self.flush(date)
+        for date in list(self.pending_writes.keys()):
+            self.finishing.append(self.finish_day(date, checkpoint=False))
+        d = DeferredList(self.finishing)
+        d.addBoth(lambda _: self.uploader.close())
+        return d
+
+    def store(self, items):
+        if self.dry_run:
+            self.stored.extend(get_article_metadata(article) for article in items)
+            return
+
+        # Publish to S3    
+        print("putting {} articles into s3".format(str(len(items))))
+        self.uploader.upload(items)
+
+        # Publish to DynamoDb
+        print("putting " + str(len(items)) + " articles into dynamodb")
+        with table.batch_writer() as batch:
+          for article in items:
+            batch.put_item(Item=get_article_metadata(article))
+
+        self.stored.extend(get_article_metadata(article) for article in items)
+
+def get_article_metadata(article):
+    return {'article_id': article['article_id'], 
+            'title': article['title'],
+            'date': article['date'],
+            'url': article['url']}
+
+def get_crawl_timeout(context):
+    '''
+    @return - seconds the crawl may run before the lambda times out, 0 for no limit
+    '''
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time is None:
+        return 0
+    return max(1, get_remaining_time() // 1000 - crawl_time_margin_sec)
+
+def get_missing_dates(start, end, completed):
+    missing = []
+    curr_date = datetime.strptime(start, '%Y-%m-%d')
+    while curr_date <= datetime.strptime(end, '%Y-%m-%d'):
+        if curr_date.strftime('%Y-%m-%d') not in completed:
+            missing.append(curr_date.strftime('%Y-%m-%d'))
+        curr_date += timedelta(days=1)
+    return missing
+
+def get_crawl_dates(event):
+    '''
+    Read the dates to crawl from the invoke payload,
+    either {'date': 'yyyy-mm-dd'} or {'start': 'yyyy-mm-dd', 'end': 'yyyy-mm-dd'}.
+    Falls back to the legacy 'date' env variable, then to today.
+    @return - keyword arguments for TechCrunchSpider
+    '''
+    try:
+        if event.get('start') and event.get('end'):
+            datetime.strptime(event['start'], "%Y-%m-%d")
+            datetime.strptime(event['end'], "%Y-%m-%d")
+            return {'start': event['start'], 'end': event['end']}
+        dateStr = event.get('date') or os.environ['date']
+        datetime.strptime(dateStr, "%Y-%m-%d")
+        return {'date': dateStr}
+    except (ValueError, KeyError) as err:
+        print("[error] cannot parse date from event!")
+        print(err)
+        return {'date': datetime.today().strftime("%Y-%m-%d")}
+
+def run_crawl(settings, crawl_args, conn):
+    '''
+    Entry point of the crawl child process, runs the crawl on a fresh reactor
+    and sends the stored article metadata and day stats back through conn
+    '''
+    try:
+        create_aws_clients()
+        process = CrawlerProcess(settings)
+        crawler = process.create_crawler(TechCrunchSpider)
+        process.crawl(crawler, **crawl_args)
+        process.start()
+        conn.send({'items': crawler.spider.stored_articles, 'day_stats': crawler.spider.day_stats,
+                   'failed_days': crawler.spider.failed_days})
+    except Exception as e:
+        conn.send({'error': repr(e)})
+    finally:
+        conn.close()
+
+def crawl_in_child_process(settings, crawl_args):
+    '''
+    The twisted reactor can not be restarted once stopped, so running CrawlerProcess
+    in the handler itself breaks the second invocation of a warm container.
+    Each crawl instead runs in a child process forked from the container, which already
+    imported scrapy, twisted and lxml and never started its own reactor,
+    so a warm invocation starts crawling right away.
+    @return - {'items': list of article metadata, 'day_stats': dict, 'failed_days': list of 'yyyy-mm-dd'}
+    '''
+    start_time = time.time()
+    recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=run_crawl, args=(settings, crawl_args, send_conn))
+    process.start()
+    send_conn.close()
+    try:
+        result = recv_conn.recv()
+    except EOFError:
+        result = None
+    process.join()
+    print("[info] crawl process finished in {} ms".format(int((time.time() - start_time) * 1000)))
+
+    if result is None:
+        raise RuntimeError("crawl process exited with code {}".format(process.exitcode))
+    if 'error' in result:
+        raise RuntimeError("crawl process failed: {}".format(result['error']))
+    return result
+
+def send_complete_message(event, status, article_count=0):
+    '''
+    Tell the web tier waiting on this crawl that it is over, through the queue it passed
+    as 'complete_queue_url' in the invoke payload, see eb-flask/article_crawler.py
+    @param status - 'done' or 'failed'
+    '''
+    queue_url = event.get('complete_queue_url')
+    if not queue_url:
+        return
+    try:
+        sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps({
+            'date': event.get('date'),
+            'request_timestamp': event.get('request_timestamp'),
+            'status': status,
+            'article_count': article_count}))
+    except ClientError as e:
+        print("[error] failed to send the complete message: {}".format(e))
+
+def lambda_handler(event, context):
+    try:
+        # crawl article on the date, or date range, given in the event payload
+        crawl_args = get_crawl_dates(event)
+        dateStr = crawl_args.get('date') or '{} to {}'.format(crawl_args['start'], crawl_args['end'])
+        # a dry run crawls and parses as usual but stores, checkpoints and notifies nothing, see benchmark.py
+        dry_run = event.get('dry_run') is True
+
+        # a range crawl resumes from the days stored by previous invocations
+        checkpoint = None
+        if 'start' in crawl_args and not dry_run:
+            checkpoint = CrawlCheckpoint(crawl_args['start'], crawl_args['end'])
+            crawl_args['skip_dates'] = checkpoint.load()
+            print("[info] {} days already crawled for range {}".format(len(checkpoint.completed), dateStr))
 
         print("[info] crawling techcrunch articles for datetime = {}".format(dateStr))
 
-        process = CrawlerProcess({
+        # every day is crawled concurrently under scrapy's scheduler,
+        # and articles are stored in batches by ArticleStoragePipeline while crawling
+        result = crawl_in_child_process({
             'USER_AGENT': 'Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 5.1)',
-            'LOG_LEVEL': 'INFO'
-        })
-        dispatcher.connect(add_item, signal=signals.item_passed)
-        process.crawl(TechCrunchSpider, date=dateStr)
-        process.start()
+            'LOG_LEVEL': 'INFO',
+            'CONCURRENT_REQUESTS': 32,
+            'CONCURRENT_REQUESTS_PER_DOMAIN': 16,
+            'CLOSESPIDER_TIMEOUT': get_crawl_timeout(context),
+            'ITEM_PIPELINES': {
+                __name__ + '.DuplicateFilterPipeline': 200,
+                __name__ + '.ArticleStoragePipeline': 300},
+            'ARTICLE_COMPRESSED': event.get('compressed') is True,
+            'ARTICLE_DRY_RUN': dry_run
+        }, dict(crawl_args, checkpoint=checkpoint))
+        items = result['items']
+        day_stats = result['day_stats']
+        for day in sorted(day_stats.keys()):
+            print("[info] {}: {} pages fetched, {} articles found".format(
+                day, day_stats[day]['pages'], day_stats[day]['articles']))
+
+        # a partially stored crawl must not be announced as fetched,
+        # the invocation fails instead and is retried by lambda, a range crawl resumes from its checkpoint
+        if len(result['failed_days']) > 0:
+            raise RuntimeError("failed to store articles for {}".format(', '.join(sorted(result['failed_days']))))
+
+        if dry_run:
+            print("[info] dry run, {} articles crawled and not stored".format(len(items)))
+            return {
+                    'statusCode': 200,
+                    'body': json.dumps('Dry run fetched {} articles from techcrunch'.format(str(len(items)))),
+                    'dayStats': day_stats
+                }
 
         # Print complete message
         print("[info] finished scraping")
@@ -143,6 +728,7 @@ def lambda_handler(event, context):
             print(title_str)
 
         # Publish to SNS topic (Differentiate test and prod SNS topic)
+        # only after the dynamodb write, as the web app reads the articles once it sees this message
         topic_arn = success_notification_sns_arn
         if ('test' in event) and (event['test'] is True):
             complete_message = "This is a TEST notification!" + br + br + complete_message
@@ -154,44 +740,34 @@ def lambda_handler(event, context):
             Message=complete_message
         )
 
-        # Publish to S3    
-        print("putting {} articles into s3".format(str(len(items))))
-        for article in items:
-            article_id = getTitleHash(article['title'])
-            article['article_id'] = article_id
-            obj = s3.Object(article_s3_bucket_name, article_id + '.json')
-            obj.put(Body=json.dumps(article))
-
-        # Publish to DynamoDb
-        print("putting " + str(len(items)) + " articles into dynamodb")
-        with table.batch_writer() as batch:
-          for article in items:
-            item = {'article_id': article['article_id'], 
-                    'title': article['title'],
-                    'date': article['date'],
-                    'url': article['url']}
-            batch.put_item(Item=item)
-
-        # Invoke the Article Analyzer Lambda (for Sentiment and Entities)
-        print("Invoking daily-article-analyzer lambda func with article_ids")
-        lambda_client.invoke(
-            FunctionName='daily-article-analyzer',
-            InvocationType='Event',
-            LogType='None',
-            Payload=json.dumps({
-                'article_ids': [article['article_id'] for article in items], 
-                'request_timestamp': 'timestamp'
-            }))
+        # Re-invoke ourselves for the days a timed out range crawl did not get to
+        if checkpoint is not None:
+            # the crawl process checkpointed its days in s3, read them back
+            checkpoint.load()
+            missing_dates = get_missing_dates(crawl_args['start'], crawl_args['end'], checkpoint.completed)
+            attempt = event.get('attempt', 0) + 1
+            if len(missing_dates) == 0:
+                checkpoint.clear()
+            elif attempt < max_resume_attempts and hasattr(context, 'function_name'):
+                print("[info] {} days left, resuming range crawl".format(len(missing_dates)))
+                lambda_client.invoke(
+                    FunctionName=context.function_name,
+                    InvocationType='Event',
+                    Payload=json.dumps(dict(event, attempt=attempt)))
 
+        send_complete_message(event, 'done', len(items))
         return {
                 'statusCode': 200,
-                'body': json.dumps('Successfully fetched {} articles from techcrunch!'.format(str(len(items))))
+                'body': json.dumps('Successfully fetched {} articles from techcrunch!'.format(str(len(items)))),
+                'dayStats': day_stats
             }
 
     except Exception as e:
         # TODO: Publish to another error SNS
         print(e)
+        if event.get('dry_run') is not True:
+            send_complete_message(event, 'failed')
         raise e
 
 if __name__ == "__main__":
-    lambda_handler({'test': True}, '')
\ No newline at end of file
+    lambda_handler({'test': True}, '')
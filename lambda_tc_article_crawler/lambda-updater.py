@@ -2,9 +2,11 @@
 
 import boto3
 import json
+from botocore.config import Config
 from datetime import datetime, timedelta
 
-client = boto3.client('lambda', region_name='us-east-1')
+# the crawl date goes in the invoke payload, the scraper configuration is never rewritten
+client = boto3.client('lambda', region_name='us-east-1', config=Config(read_timeout=15 * 60))
 
 def lambda_handler(event, context):
     # fetch yesterday's article 
@@ -14,21 +16,13 @@ def lambda_handler(event, context):
     dateObj -= timedelta(days=1)
     today_date_str = dateObj.strftime("%Y-%m-%d")
     
-    update_response = client.update_function_configuration(
-        FunctionName='daily-article-dev-scraper',
-        Environment={
-            'Variables': {
-                'date': today_date_str
-            }
-        })
-
     invoke_response = client.invoke(
             FunctionName='daily-article-dev-scraper',
             InvocationType='RequestResponse',
             LogType='None',
             Payload=json.dumps({
                 'date': today_date_str, 
-                'request_timestamp': 'timestamp'
+                'request_timestamp': timestamp
             }))
 
     return {
@@ -0,0 +1,77 @@
+# Offline end to end benchmark of batch_analyze_articles on the local analyzer backend
+#
+# $python analyzer-benchmark.py --articles 500 --latency 0.3 --concurrency 1 4 8 16
+#
+# Articles are generated, or loaded from a json list of {'article_id', 'title', 'date', 'url', 'text'}
+# with --input, and analyzed with each concurrency setting against a LocalBackend
+# mimicking Comprehend's latency and throttling.
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import time
+
+from analyzer_backends import LocalBackend
+
+# aws clients are created on import, none of them is called here
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+spec = importlib.util.spec_from_file_location(
+    'article_retriever', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'article-retriever.py'))
+article_retriever = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(article_retriever)
+
+sample_words = (
+    'Apple', 'Google', 'Tesla', 'startup', 'raises', 'funding', 'growth', 'loss', 'launch', 'product',
+    'users', 'market', 'lawsuit', 'record', 'revenue', 'investors', 'the', 'a', 'new', 'today', 'said',
+    'company', 'breach', 'strong', 'weak', 'Series', 'B', 'round', 'led', 'by', 'Sequoia', 'Capital')
+
+def generate_articles(count, words_per_article, seed=0):
+    rand = random.Random(seed)
+    articles = []
+    for i in range(count):
+        text = ' '.join(rand.choice(sample_words) for _ in range(words_per_article)) + '.'
+        articles.append({
+            'article_id': str(i),
+            'title': 'Article {}'.format(i),
+            'date': '2019/09/20',
+            'url': 'https://techcrunch.com/{}'.format(i),
+            'text': text})
+    return articles
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', help='json file with a list of articles')
+    parser.add_argument('--articles', type=int, default=500, help='number of generated articles')
+    parser.add_argument('--words', type=int, default=600, help='words per generated article')
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds per backend call')
+    parser.add_argument('--latency-per-text', type=float, default=0.0, help='seconds per text of a call')
+    parser.add_argument('--jitter', type=float, default=0.05, help='max random seconds per call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='probability of a throttled call')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--summarize', action='store_true')
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input) as f:
+            source_articles = json.load(f)
+    else:
+        source_articles = generate_articles(args.articles, args.words)
+
+    # keep the per-stage metrics quiet, only the summary line is printed
+    article_retriever.metrics_hook = lambda stage, **fields: None
+
+    for concurrency in args.concurrency:
+        backend = LocalBackend(latency=args.latency, latency_per_text=args.latency_per_text,
+                               jitter=args.jitter, throttle_rate=args.throttle_rate, seed=0)
+        article_retriever.set_analyzer_backend(backend)
+        articles = [dict(article) for article in source_articles]
+
+        start_time = time.time()
+        analyzed = article_retriever.batch_analyze_articles(
+            articles, max_concurrency=concurrency, summarize=args.summarize)
+        seconds = time.time() - start_time
+
+        print("concurrency {:>3}: {:>5} articles in {:>7.2f}s, {:>8.1f} articles/s, {} backend calls".format(
+            concurrency, len(analyzed), seconds, len(analyzed) / max(seconds, 1e-9), backend.calls))
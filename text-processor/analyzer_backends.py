@@ -0,0 +1,174 @@
+# Analyzer backends used by article-retriever.py
+#
+# A backend exposes the two Comprehend calls the analyzer uses,
+#   batch_detect_sentiment(TextList=[...], LanguageCode='en')
+#   batch_detect_entities(TextList=[...], LanguageCode='en')
+# and returns responses shaped like Comprehend's ({'ResultList': [...], 'ErrorList': [...]}).
+#
+# ComprehendBackend calls AWS Comprehend, LocalBackend analyzes in process
+# so the analyzer can be load tested and profiled offline.
+
+import random
+import re
+import threading
+import time
+
+import boto3
+import numpy as np
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+comprehend_max_text_bytes = 5000
+
+class ComprehendBackend:
+    def __init__(self, region_name='us-east-1', max_pool_connections=10):
+        self.client = boto3.client(service_name='comprehend', region_name=region_name,
+                                   config=Config(max_pool_connections=max_pool_connections))
+
+    def batch_detect_sentiment(self, TextList, LanguageCode='en'):
+        return self.client.batch_detect_sentiment(TextList=TextList, LanguageCode=LanguageCode)
+
+    def batch_detect_entities(self, TextList, LanguageCode='en'):
+        return self.client.batch_detect_entities(TextList=TextList, LanguageCode=LanguageCode)
+
+
+positive_words = (
+    'good', 'great', 'best', 'better', 'win', 'wins', 'won', 'growth', 'grow', 'grows', 'profit',
+    'profitable', 'success', 'successful', 'launch', 'launches', 'raise', 'raises', 'raised',
+    'gain', 'gains', 'strong', 'improve', 'improved', 'improves', 'innovative', 'popular', 'love',
+    'record', 'boost', 'boosts', 'easy', 'fast', 'free', 'exciting', 'positive', 'lead', 'leading')
+negative_words = (
+    'bad', 'worse', 'worst', 'lose', 'loses', 'lost', 'loss', 'losses', 'decline', 'declines',
+    'fail', 'fails', 'failed', 'failure', 'breach', 'hack', 'hacked', 'lawsuit', 'sue', 'sued',
+    'fine', 'fined', 'layoff', 'layoffs', 'cut', 'cuts', 'weak', 'problem', 'problems', 'risk',
+    'bug', 'crash', 'scandal', 'fraud', 'shutdown', 'ban', 'banned', 'negative', 'slow', 'down')
+entity_stop_words = frozenset((
+    'The', 'A', 'An', 'And', 'But', 'Or', 'If', 'In', 'On', 'At', 'For', 'With', 'This', 'That',
+    'These', 'Those', 'It', 'Its', 'We', 'He', 'She', 'They', 'I', 'You', 'As', 'So', 'To', 'Of'))
+
+word_pattern = re.compile(r"[a-z][a-z'-]+")
+entity_pattern = re.compile(r"\b[A-Z][\w&.'-]*(?:\s+[A-Z][\w&.'-]*)*")
+
+class LocalBackend:
+    '''
+    Offline stand-in for Comprehend: lexicon based sentiment scored for a whole batch
+    with numpy, and capitalized phrases as entities.
+    Latency and throttling can be injected to mimic the real service.
+    '''
+    def __init__(self, latency=0.0, latency_per_text=0.0, jitter=0.0, throttle_rate=0.0, seed=None):
+        '''
+        @param latency - seconds added to every call
+        @param latency_per_text - seconds added per text of the batch
+        @param jitter - max random seconds added to every call
+        @param throttle_rate - probability of a call failing with ThrottlingException
+        '''
+        self.latency = latency
+        self.latency_per_text = latency_per_text
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+        self.vocabulary = {}
+        polarity = []
+        for word in positive_words:
+            self.vocabulary[word] = len(polarity)
+            polarity.append(1.0)
+        for word in negative_words:
+            self.vocabulary[word] = len(polarity)
+            polarity.append(-1.0)
+        self.polarity = np.array(polarity)
+
+    def simulate_call(self, operation, texts):
+        with self._lock:
+            self.calls += 1
+            throttled = self.random.random() < self.throttle_rate
+            delay = self.latency + self.latency_per_text * len(texts) + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if throttled:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+
+    def split_valid(self, texts):
+        '''
+        @return - (list of (index, text) under the size limit, comprehend style ErrorList for the others)
+        '''
+        valid = []
+        errors = []
+        for i, text in enumerate(texts):
+            if len(text.encode('utf8')) > comprehend_max_text_bytes:
+                errors.append({'Index': i, 'ErrorCode': 'TextSizeLimitExceededException',
+                               'ErrorMessage': 'Input text size exceeds limit'})
+            else:
+                valid.append((i, text))
+        return valid, errors
+
+    def batch_detect_sentiment(self, TextList, LanguageCode='en'):
+        self.simulate_call('BatchDetectSentiment', TextList)
+        valid, errors = self.split_valid(TextList)
+        if len(valid) == 0:
+            return {'ResultList': [], 'ErrorList': errors}
+
+        # lexicon hits of the whole batch as one document x lexicon count matrix
+        doc_ids = []
+        word_ids = []
+        word_counts = np.zeros(len(valid))
+        for doc, (i, text) in enumerate(valid):
+            words = word_pattern.findall(text.lower())
+            word_counts[doc] = len(words)
+            for word in words:
+                word_id = self.vocabulary.get(word)
+                if word_id is not None:
+                    doc_ids.append(doc)
+                    word_ids.append(word_id)
+        counts = np.zeros((len(valid), len(self.polarity)))
+        np.add.at(counts, (np.array(doc_ids, dtype=int), np.array(word_ids, dtype=int)), 1)
+
+        positive = counts @ (self.polarity > 0)
+        negative = counts @ (self.polarity < 0)
+        hits = positive + negative
+        density = hits / np.maximum(word_counts, 1)
+        polar = np.minimum(1.0, density * 10)
+        scores = np.stack([
+            polar * positive / np.maximum(hits, 1),
+            polar * negative / np.maximum(hits, 1),
+            1.0 - polar,
+            polar * np.minimum(positive, negative) / np.maximum(hits, 1)], axis=1)
+        scores /= scores.sum(axis=1, keepdims=True)
+        labels = np.array(['POSITIVE', 'NEGATIVE', 'NEUTRAL', 'MIXED'])[scores.argmax(axis=1)]
+
+        results = [{
+            'Index': i,
+            'Sentiment': str(labels[doc]),
+            'SentimentScore': {
+                'Positive': float(scores[doc, 0]),
+                'Negative': float(scores[doc, 1]),
+                'Neutral': float(scores[doc, 2]),
+                'Mixed': float(scores[doc, 3])}
+            } for doc, (i, text) in enumerate(valid)]
+        return {'ResultList': results, 'ErrorList': errors}
+
+    def batch_detect_entities(self, TextList, LanguageCode='en'):
+        self.simulate_call('BatchDetectEntities', TextList)
+        valid, errors = self.split_valid(TextList)
+        results = []
+        for i, text in valid:
+            entities = []
+            for match in entity_pattern.finditer(text):
+                words = match.group(0).split()
+                while words and words[0] in entity_stop_words:
+                    words.pop(0)
+                if len(words) == 0:
+                    continue
+                phrase = ' '.join(words)
+                entity = phrase.rstrip(".'-")
+                end = match.end() - (len(phrase) - len(entity))
+                entities.append({
+                    'Text': entity,
+                    'Type': 'ORGANIZATION' if len(words) == 1 else 'OTHER',
+                    'Score': 0.5,
+                    'BeginOffset': end - len(entity),
+                    'EndOffset': end})
+            results.append({'Index': i, 'Entities': entities})
+        return {'ResultList': results, 'ErrorList': errors}
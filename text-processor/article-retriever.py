@@ -1,26 +1,68 @@
 #%%
 import boto3
 import botocore
+import gzip
+import hashlib
 import json
-from botocore.exceptions import ClientError
+import os
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeSerializer
 from decimal import Decimal
 
-import pprint
-pp = pprint.PrettyPrinter(indent=4)
-
+import random
+import re
+import threading
 import time
 from sys import getsizeof
 
+from analyzer_backends import ComprehendBackend, LocalBackend
+
 
 # config metadata
 region_name = 'us-east-1'
 article_dynamodb_table_name = 'ArticleMetadata'
 article_s3_bucket_name = 'techcrunch-article-set'
-
-s3_client = boto3.client('s3')
-comprehend = boto3.client(service_name='comprehend', region_name=region_name)
-dynamo_table = boto3.resource('dynamodb', region_name=region_name).Table(article_dynamodb_table_name)
+article_s3_bundle_prefix = 'daily/'
+s3_fetch_workers = 32
+comprehend_batch_size = 25
+comprehend_concurrency = 8
+comprehend_max_attempts = 8
+# comprehend rejects documents over 5000 bytes, keep some margin
+comprehend_max_text_bytes = 4900
+# total text per batch request, below comprehend_batch_size * comprehend_max_text_bytes so that
+# batches of long articles are split, and a throttled retry resends at most this much
+comprehend_max_batch_bytes = 64 * 1024
+dynamo_write_workers = 8
+analysis_manifest_path = 'analysis-manifest.json'
+# adjacency items written next to the articles in the article table,
+#   date='ENTITY#<entity>',        article_id='<yyyy/mm/dd>#<article_id>' - articles mentioning an entity by date
+#   date='SENTIMENT#<yyyy/mm/dd>', article_id='<SENTIMENT>#<article_id>'  - sentiment rollup of a date
+entity_index_prefix = 'ENTITY#'
+sentiment_index_prefix = 'SENTIMENT#'
+max_indexed_entities = 25
+
+# connection pool sized for the concurrent body fetches
+s3_client = boto3.client('s3', config=Config(max_pool_connections=s3_fetch_workers))
+dynamo_table = boto3.resource('dynamodb', region_name=region_name,
+                              config=Config(max_pool_connections=dynamo_write_workers)).Table(article_dynamodb_table_name)
+# resources are not thread safe, the concurrent analysis writes go through a shared low level client
+dynamo_client = boto3.client('dynamodb', region_name=region_name,
+                             config=Config(max_pool_connections=dynamo_write_workers))
+serializer = TypeSerializer()
+
+# analyzer backend, Comprehend unless ANALYZER_BACKEND=local (see analyzer_backends.py)
+if os.environ.get('ANALYZER_BACKEND') == 'local':
+    comprehend = LocalBackend()
+else:
+    comprehend = ComprehendBackend(region_name=region_name, max_pool_connections=comprehend_concurrency)
+
+def set_analyzer_backend(backend):
+    global comprehend
+    comprehend = backend
 
 def get_articles_by_date(date_str):
     response = dynamo_table.query(KeyConditionExpression=Key('date').eq(date_str))
@@ -32,119 +74,516 @@ def get_articles_by_date(date_str):
         return []
     articles = [article for article in response['Items']]
 
-    for article in articles:
-        article['text'] = get_article_by_id(article['article_id'])['text']
+    bodies, failures = load_article_bodies([article['article_id'] for article in articles], [date_str] * len(articles))
+    for article, body in zip(articles, bodies):
+        article['text'] = body['text'] if body else ''
+    report_failures(failures)
     return articles
 
-def get_articles_by_ids(ids):
+def get_articles_by_ids(ids, date_str=None):
+    '''
+    @param ids - list of article_id, as sent by the scraper to the analyzer
+    @param date_str - date string of format yyyy/mm/dd the articles were published on,
+                      the 'date' of the scraper payload, needed for the articles of compressed crawls
+                      which only exist in the daily bundle
+    '''
+    bodies, failures = load_article_bodies(ids, [date_str] * len(ids) if date_str else None)
     articles = []
-    for article_id in ids:
-        response = s3_client.get_object(
-            Bucket=article_s3_bucket_name, 
-            Key=article_id+'.json')
-        article = json.loads(response['Body'].read().decode('utf-8'))
+    for article_id, article in zip(ids, bodies):
+        if article is None:
+            continue
         article['article_id'] = article_id
         articles.append(article)
+    report_failures(failures)
     return articles
 
-def get_article_by_id(article_id):
-    response = s3_client.get_object(
-        Bucket=article_s3_bucket_name, 
-        Key=article_id+'.json')
+def get_article_by_id(article_id, date_str=None):
+    '''
+    Get the article body from its own s3 object, or from the daily bundle
+    written by the scraper in compressed mode when date_str is given
+    @param date_str - date string of format yyyy/mm/dd
+    '''
+    try:
+        response = s3_client.get_object(
+            Bucket=article_s3_bucket_name, 
+            Key=article_id+'.json')
+    except ClientError as e:
+        if date_str is None or e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return get_article_from_bundle(article_id, date_str)
     return json.loads(response['Body'].read().decode('utf-8'))
 
-def batch_analyze_articles(articles):
-    process_articles = [article for article in articles if len(article['text']) > 0]
-    process_texts = [article['text'][:4500] for article in process_articles]
-    batches = divide_chunks(process_texts, 25)
-
-    pp.pprint("Total articles to be processed = {}".format(len(process_articles)))
-    pp.pprint("Total number of batches = {}".format(len(batches)))
+@lru_cache(maxsize=32)
+def get_bundle_index(date_str):
+    response = s3_client.get_object(
+        Bucket=article_s3_bucket_name,
+        Key=article_s3_bundle_prefix + date_str.replace('/', '-') + '.index.json')
+    return json.loads(response['Body'].read().decode('utf-8'))
 
-    pp.pprint('Calling DetectSentiment')
+def get_article_from_bundle(article_id, date_str):
+    '''
+    Read a single article out of a daily bundle with a ranged get of its gzip member
+    '''
+    index = get_bundle_index(date_str)
+    entry = index['articles'][article_id]
+    response = s3_client.get_object(
+        Bucket=article_s3_bucket_name,
+        Key=index['key'],
+        Range='bytes={}-{}'.format(entry['offset'], entry['offset'] + entry['length'] - 1))
+    return json.loads(gzip.decompress(response['Body'].read()).decode('utf-8'))
+
+def iter_article_bodies(ids, dates=None, max_workers=s3_fetch_workers):
+    '''
+    Fetch article bodies from s3 concurrently, yielding each one as soon as it arrives
+    @param ids - list of article_id
+    @param dates - optional list of date string aligned with ids, to find bundled articles
+    @return - generator of (index in ids, article_id, article dict or None, error or None)
+    '''
+    dates = dates or [None] * len(ids)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_article_by_id, article_id, date_str): (i, article_id)
+                    for i, (article_id, date_str) in enumerate(zip(ids, dates))}
+        for future in as_completed(futures):
+            i, article_id = futures[future]
+            # a failed fetch only fails its article, connection errors and corrupt bundles included
+            try:
+                yield i, article_id, future.result(), None
+            except (ClientError, BotoCoreError, KeyError, ValueError, OSError, EOFError) as e:
+                yield i, article_id, None, e
+
+def load_article_bodies(ids, dates=None, max_workers=s3_fetch_workers):
+    '''
+    Fetch article bodies from s3 concurrently
+    @return - (list of article dict or None aligned with ids, {article_id: error string} of failed fetches)
+    '''
+    bodies = [None] * len(ids)
+    failures = {}
+    for i, article_id, article, error in iter_article_bodies(ids, dates, max_workers):
+        bodies[i] = article
+        if error is not None:
+            failures[article_id] = str(error)
+    return bodies, failures
+
+def report_failures(failures):
+    if len(failures) > 0:
+        print("Failed to fetch {} article bodies from s3".format(len(failures)))
+        for article_id, error in failures.items():
+            print("  {}: {}".format(article_id, error))
+
+def stream_analyze_articles(articles, chunk_size=100):
+    '''
+    Fetch the bodies of articles and analyze them chunk by chunk as the bodies arrive,
+    instead of waiting for every body first
+    @param articles - list of article dict with 'article_id' and 'date', as stored in dynamodb
+    @return - generator of analyzed article dict
+    '''
+    ready = []
+    fetched = iter_article_bodies(
+        [article['article_id'] for article in articles],
+        [article.get('date') for article in articles])
+    for i, article_id, body, error in fetched:
+        if error is not None:
+            print("Failed to fetch article {}: {}".format(article_id, error))
+            continue
+        articles[i]['text'] = body['text']
+        ready.append(articles[i])
+        if len(ready) >= chunk_size:
+            yield from batch_analyze_articles(ready)
+            ready = []
+    if len(ready) > 0:
+        yield from batch_analyze_articles(ready)
+
+def print_metrics(stage, **fields):
+    print("[metrics] {} {}".format(stage, json.dumps(fields, sort_keys=True)))
+
+# called as metrics_hook(stage, **fields) with per-stage counts and timings,
+# replace it to ship the metrics somewhere else
+metrics_hook = print_metrics
+
+class AdaptiveThrottle:
+    '''
+    Delay shared by all concurrent comprehend calls,
+    doubled every time comprehend throttles and halved back on every success
+    '''
+    def __init__(self, base_delay=0.1, max_delay=10.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay > 0:
+            time.sleep(random.uniform(delay / 2, delay))
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttled += 1
+            self.delay = min(self.max_delay, max(self.base_delay, self.delay * 2))
+
+    def on_success(self):
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > self.base_delay else 0
+
+def call_with_backoff(func, throttle, **kwargs):
+    for attempt in range(comprehend_max_attempts):
+        throttle.wait()
+        try:
+            response = func(**kwargs)
+            throttle.on_success()
+            return response
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('ThrottlingException', 'TooManyRequestsException') or \
+                    attempt == comprehend_max_attempts - 1:
+                raise
+            throttle.on_throttle()
+
+def detect_sentiment(texts, throttle):
+    response = call_with_backoff(comprehend.batch_detect_sentiment, throttle, TextList=texts, LanguageCode='en')
+    results = {}
+    for sent in response['ResultList']:
+        scores = {}
+        for key, score in sent['SentimentScore'].items():
+            scores[key] = Decimal(str(score))
+        results[sent['Index']] = {
+            'Sentiment': sent['Sentiment'], 
+            'SentimentScore': scores
+        }
+    return results, response['ErrorList']
+
+def detect_entities(texts, throttle):
+    response = call_with_backoff(comprehend.batch_detect_entities, throttle, TextList=texts, LanguageCode='en')
+    results = {}
+    for ent in response['ResultList']:
+        results[ent['Index']] = dedup_list([entry['Text'] for entry in ent['Entities']])
+    return results, response['ErrorList']
+
+def batch_analyze_articles(articles, max_concurrency=comprehend_concurrency, summarize=False):
+    '''
+    Detect sentiment and entities of articles, running the batches of both detectors
+    concurrently with at most max_concurrency comprehend calls in flight
+    @param summarize - shorten long articles to their most informative sentences instead of cutting their tail
+    @return - analyzed articles, with 'Sentiment' and 'Entities' set
+    '''
     start_time = time.time()
+    process_articles = [article for article in articles if len(article['text']) > 0]
+    prepared = [prepare_text(article['text'], comprehend_max_text_bytes, summarize) for article in process_articles]
+    batches = pack_batches(prepared, comprehend_batch_size, comprehend_max_batch_bytes)
+
+    # global index of the first text of each batch
+    offsets = []
+    count = 0
+    for batch in batches:
+        offsets.append(count)
+        count += len(batch)
+
+    metrics_hook('prepare', articles=len(process_articles), batches=len(batches),
+                 bytes=sum(size for text, size in prepared), seconds=time.time() - start_time)
+
+    detectors = {'sentiment': detect_sentiment, 'entities': detect_entities}
+    results = {'sentiment': {}, 'entities': {}}
+    stage_seconds = {'sentiment': 0.0, 'entities': 0.0}
+    errors = {'sentiment': 0, 'entities': 0}
+    throttle = AdaptiveThrottle()
+
+    def run_batch(name, i):
+        call_start = time.time()
+        batch_results, error_list = detectors[name](batches[i], throttle)
+        return name, i, batch_results, error_list, time.time() - call_start
 
-    sentiment_results = {}
-    for i in range(0, len(batches)):
-        count = i * 25
-        response = comprehend.batch_detect_sentiment(
-            TextList=batches[i], LanguageCode='en'
-        )
-
-        if len(response['ErrorList']) > 0:
-            print("Error for detect sentiment in batch {}!".format(i))
-            print(response['ErrorList'])
-
-        for sent in response['ResultList']:
-            scores = {}
-            for key, score in sent['SentimentScore'].items():
-                scores[key] = Decimal(score)
-            
-            sentiment_results[count + sent['Index']] = {
-                'Sentiment': sent['Sentiment'], 
-                'SentimentScore': scores
-            }
-
-    pp.pprint("--- DetectSentiment took {} seconds ---".format(time.time() - start_time))
-
-    pp.pprint('Calling DetectEntities')
     start_time = time.time()
-
-    entities_results = {}
-    for i in range(0, len(batches)):
-        count = i * 25
-        response = comprehend.batch_detect_entities(
-            TextList=batches[i], LanguageCode='en'
-        )
-        
-        if len(response['ErrorList']) > 0:
-            print("Error for detect entities in batch {}!".format(i))
-            print(response['ErrorList'])
-        
-        for ent in response['ResultList']:
-            entity_list = dedup_list([entry['Text'] for entry in ent['Entities']])
-            entities_results[count + ent['Index']] = entity_list
-
-    pp.pprint("--- DetectEntities took {} seconds ---".format(time.time() - start_time))
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = [executor.submit(run_batch, name, i) for i in range(len(batches)) for name in detectors]
+        for future in as_completed(futures):
+            name, i, batch_results, error_list, seconds = future.result()
+            stage_seconds[name] += seconds
+            if len(error_list) > 0:
+                errors[name] += len(error_list)
+                print("Error for detect {} in batch {}!".format(name, i))
+                print(error_list)
+            for index, result in batch_results.items():
+                results[name][offsets[i] + index] = result
+
+    for name in detectors:
+        metrics_hook('detect_' + name, batches=len(batches), errors=errors[name], call_seconds=stage_seconds[name])
+    metrics_hook('analyze', articles=len(process_articles), concurrency=max_concurrency,
+                 throttled=throttle.throttled, seconds=time.time() - start_time)
 
     for i, article in enumerate(process_articles):
-        if i in sentiment_results:
-            article['Sentiment'] = sentiment_results[i]
-        if i in entities_results:
-            article['Entities'] = entities_results[i]
+        if i in results['sentiment']:
+            article['Sentiment'] = results['sentiment'][i]
+        if i in results['entities']:
+            article['Entities'] = results['entities'][i]
 
     return process_articles
 
-def put_updated_articles(article_list):
-    pp.pprint("Writing {} analyzed articles into dynamodb".format(len(article_list)))
-    with dynamo_table.batch_writer() as batch:
-        for article in article_list:
-            item = {'article_id': article['article_id'], 
-                    'title': article['title'],
-                    'date': article['date'],
-                    'url': article['url']}
-            if 'Sentiment' in article:
-                item['sentiment'] = article['Sentiment']
-            if 'Entities' in article:
-                item['entities'] = article['Entities']
+def get_text_hash(text):
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+class AnalysisManifest:
+    '''
+    Local record of the text hash each article was last analyzed with,
+    so reruns and dry runs can tell unchanged articles apart without asking dynamodb
+    '''
+    def __init__(self, path=analysis_manifest_path):
+        self.path = path
+        self.hashes = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.hashes = json.load(f)
+
+    def is_current(self, article_id, text_hash):
+        return self.hashes.get(article_id) == text_hash
+
+    def update(self, article_id, text_hash):
+        self.hashes[article_id] = text_hash
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.hashes, f)
+        os.replace(tmp_path, self.path)
+
+def needs_analysis(article, manifest):
+    '''
+    An article needs analysis unless the manifest has its current text hash,
+    or its dynamodb item already carries sentiment and entities for the same text
+    (items analyzed before text hashes were stored are taken as they are)
+    '''
+    if len(article['text']) == 0:
+        return False
+    article['TextHash'] = get_text_hash(article['text'])
+    if manifest.is_current(article['article_id'], article['TextHash']):
+        return False
+    if 'sentiment' in article and 'entities' in article:
+        return article.get('text_hash', article['TextHash']) != article['TextHash']
+    return True
+
+def incremental_analyze_articles(articles, manifest=None, dry_run=False):
+    '''
+    Analyze and write back only the new or changed articles
+    @param articles - article dict with 'text', as returned by get_articles_by_date
+    @param dry_run - only report what would be analyzed
+    @return - the analyzed articles, or the articles to analyze on a dry run
+    '''
+    manifest = manifest or AnalysisManifest()
+    changed = [article for article in articles if needs_analysis(article, manifest)]
+    metrics_hook('incremental', articles=len(articles), changed=len(changed),
+                 skipped=len(articles) - len(changed), dry_run=dry_run)
+    if dry_run or len(changed) == 0:
+        return changed
+
+    analyzed = batch_analyze_articles(changed)
+    put_updated_articles(analyzed)
+    for article in analyzed:
+        if 'Sentiment' in article and 'Entities' in article:
+            manifest.update(article['article_id'], article['TextHash'])
+    manifest.save()
+    return analyzed
+
+def get_changed_attributes(article):
+    '''
+    @return - {dynamodb attribute: new value} of the analysis results differing from the stored item
+    '''
+    changes = {}
+    for result_key, attribute in (('Sentiment', 'sentiment'), ('Entities', 'entities'), ('TextHash', 'text_hash')):
+        if result_key in article and article[result_key] != article.get(attribute):
+            changes[attribute] = article[result_key]
+    return changes
+
+def update_article(article):
+    '''
+    Write only the changed analysis attributes of an article with an update expression
+    @return - True if the item was updated
+    '''
+    changes = get_changed_attributes(article)
+    if len(changes) == 0:
+        return False
+    names = {}
+    values = {}
+    assignments = []
+    for i, (attribute, value) in enumerate(changes.items()):
+        names['#a{}'.format(i)] = attribute
+        values[':v{}'.format(i)] = serializer.serialize(value)
+        assignments.append('#a{0} = :v{0}'.format(i))
+    dynamo_client.update_item(
+        TableName=article_dynamodb_table_name,
+        Key={'date': {'S': article['date']}, 'article_id': {'S': article['article_id']}},
+        UpdateExpression='SET ' + ', '.join(assignments),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values)
+    return True
+
+def get_entity_key(entity):
+    return entity_index_prefix + ' '.join(entity.lower().split())
+
+def get_indexed_entities(entities):
+    '''
+    @return - {entity key: entity text} of the first max_indexed_entities distinct entities
+    '''
+    indexed = {}
+    for entity in entities or []:
+        key = get_entity_key(entity)
+        if key != entity_index_prefix and key not in indexed:
+            indexed[key] = entity
+            if len(indexed) == max_indexed_entities:
+                break
+    return indexed
+
+def get_index_changes(article, rebuild=False):
+    '''
+    Entity and sentiment index items of an analyzed article, compared with
+    what the stored item was indexed under before
+    @param rebuild - index the article even if the stored item already had the same analysis
+    @return - (list of items to put, list of keys to delete)
+    '''
+    puts = []
+    deletes = []
+    sort_suffix = '#' + article['article_id']
+    summary = {'title': article['title'], 'url': article.get('url')}
+
+    old_sentiment = article.get('sentiment')
+    sentiment = article.get('Sentiment', old_sentiment if rebuild else None)
+    if sentiment is not None and (rebuild or sentiment != old_sentiment):
+        label = sentiment['Sentiment']
+        rollup_key = sentiment_index_prefix + article['date']
+        if old_sentiment is not None and old_sentiment['Sentiment'] != label:
+            deletes.append({'date': rollup_key, 'article_id': old_sentiment['Sentiment'] + sort_suffix})
+        puts.append(dict(summary, date=rollup_key, article_id=label + sort_suffix,
+                         score=sentiment['SentimentScore'][label.capitalize()]))
+
+    old_entities = article.get('entities')
+    entities = article.get('Entities', old_entities if rebuild else None)
+    if entities is not None and (rebuild or entities != old_entities or sentiment != old_sentiment):
+        indexed = get_indexed_entities(entities)
+        entity_sort_key = article['date'] + sort_suffix
+        for key in get_indexed_entities(old_entities):
+            if key not in indexed:
+                deletes.append({'date': key, 'article_id': entity_sort_key})
+        for key, entity in indexed.items():
+            item = dict(summary, date=key, article_id=entity_sort_key, entity=entity)
+            if sentiment is not None:
+                item['sentiment'] = sentiment['Sentiment']
+            puts.append(item)
+    return puts, deletes
+
+def put_index_changes(article_list, rebuild=False):
+    '''
+    Write the entity and sentiment index items of the analyzed articles
+    '''
+    start_time = time.time()
+    puts = []
+    deletes = []
+    for article in article_list:
+        article_puts, article_deletes = get_index_changes(article, rebuild)
+        puts += article_puts
+        deletes += article_deletes
+    # the batch writer drops earlier requests on the same key
+    with dynamo_table.batch_writer(overwrite_by_pkeys=['date', 'article_id']) as batch:
+        for key in deletes:
+            batch.delete_item(Key=key)
+        for item in puts:
             batch.put_item(Item=item)
+    metrics_hook('index', articles=len(article_list), puts=len(puts), deletes=len(deletes),
+                 seconds=time.time() - start_time)
+
+def put_updated_articles(article_list, rebuild_index=False):
+    '''
+    Write back the analysis results, then index the articles whose results changed
+    @param rebuild_index - index every article, to backfill articles analyzed before the index existed
+    '''
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=dynamo_write_workers) as executor:
+        updated = list(executor.map(update_article, article_list))
+    metrics_hook('write', articles=len(article_list), updated=sum(updated), seconds=time.time() - start_time)
+    put_index_changes([article for article, changed in zip(article_list, updated) if changed or rebuild_index],
+                      rebuild_index)
 
 # Functions to truncate text into certain bytes
 # Because Comprehend Sentiment api only take max of 5000 bytes
 def utf8_lead_byte(b):
     '''A UTF-8 intermediate byte starts with the bits 10xxxxxx.'''
-    return (ord(b) & 0xC0) != 0x80
+    return (b & 0xC0) != 0x80
 
-def utf8_byte_truncate(text, max_bytes):
+def utf8_byte_truncate(text, max_bytes, utf8=None):
     '''If text[max_bytes] is not a lead byte, back up until a lead byte is
-    found and truncate before that character.'''
-    utf8 = text.encode('utf8')
+    found and truncate before that character.
+    @param utf8 - text already encoded, to avoid encoding it again
+    @return - (truncated text, its size in bytes)'''
+    if utf8 is None:
+        utf8 = text.encode('utf8')
     if len(utf8) <= max_bytes:
-        return utf8
+        return text, len(utf8)
     i = max_bytes
     while i > 0 and not utf8_lead_byte(utf8[i]):
         i -= 1
-    return utf8[:i]
+    return utf8[:i].decode('utf8'), i
+
+sentence_pattern = re.compile(r'(?<=[.!?])\s+')
+word_pattern = re.compile(r"[a-z][a-z'-]+")
+stop_words = frozenset((
+    'the', 'and', 'for', 'that', 'with', 'this', 'are', 'was', 'were', 'from', 'have', 'has',
+    'had', 'but', 'not', 'you', 'your', 'its', "it's", 'they', 'their', 'there', 'what', 'which',
+    'who', 'will', 'would', 'can', 'could', 'about', 'into', 'than', 'then', 'also', 'more',
+    'our', 'out', 'all', 'been', 'one', 'said', 'says', 'just', 'some', 'when', 'over', 'like'))
+
+def summarize_text(text, max_bytes):
+    '''
+    Extractive summary, keeps the sentences with the highest average word frequency
+    in their original order until max_bytes is reached
+    '''
+    sentences = [sentence for sentence in sentence_pattern.split(text) if sentence]
+    sentence_words = [[word for word in word_pattern.findall(sentence.lower()) if word not in stop_words]
+                      for sentence in sentences]
+    frequency = {}
+    for words in sentence_words:
+        for word in words:
+            frequency[word] = frequency.get(word, 0) + 1
+
+    scores = [sum(frequency[word] for word in words) / (len(words) + 1) for words in sentence_words]
+    picked = set()
+    size = 0
+    for i in sorted(range(len(sentences)), key=lambda i: -scores[i]):
+        sentence_size = len(sentences[i].encode('utf8')) + 1
+        if size + sentence_size <= max_bytes:
+            picked.add(i)
+            size += sentence_size
+    return ' '.join(sentences[i] for i in sorted(picked))
+
+def prepare_text(text, max_bytes, summarize=False):
+    '''
+    Fit text into max_bytes of UTF-8 without cutting a character in half,
+    encoding the full text only once
+    @param summarize - summarize texts over max_bytes instead of cutting their tail
+    @return - (text, size in bytes)
+    '''
+    utf8 = text.encode('utf8')
+    if len(utf8) > max_bytes and summarize:
+        text = summarize_text(text, max_bytes) or text
+        utf8 = None
+    return utf8_byte_truncate(text, max_bytes, utf8)
+
+def pack_batches(prepared, max_count, max_bytes):
+    '''
+    Split prepared texts into consecutive batches of at most max_count texts
+    and max_bytes total payload
+    @param prepared - list of (text, size in bytes)
+    @return - list of list of text
+    '''
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for text, size in prepared:
+        if len(batch) > 0 and (len(batch) >= max_count or batch_bytes + size > max_bytes):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(text)
+        batch_bytes += size
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
 
 # Helper methods
 # Divide a list l into a list of sublist and each one with max size of n
@@ -179,30 +618,36 @@ if __name__ == '__main__':
     date = '2019/09/20'
     articles = get_articles_by_date(date)
     
-    batch_analyze_articles(articles)
+    incremental_analyze_articles(articles, dry_run=True)
 
     print("--- %s seconds ---" % (time.time() - start_time))
     
 
 #%%
-date = '2019/09/20'
-articles = get_articles_by_date(date)
+if __name__ == '__main__':
+    date = '2019/09/20'
+    articles = get_articles_by_date(date)
 
 
 #%%
-batch_analyze_articles(articles)
+if __name__ == '__main__':
+    batch_analyze_articles(articles)
 
 #%%
-
-
-put_updated_articles(articles)
+if __name__ == '__main__':
+    put_updated_articles(articles)
 
 #%%
+if __name__ == '__main__':
+    # backfill the entity and sentiment index of articles analyzed before it existed
+    put_index_changes(get_articles_by_date('2019/09/20'), rebuild=True)
 
-test_articles = get_articles_by_ids([
-    '0160459551e2d05d37d696dcbfedbe3165b7e6a0a649f97a2d643ea42a9066f4',
-    '086b01d02525187dfa7ba55891dfa3adaaf1ccedc7fb1c697c0563bdc04a0de5'
-    ])
+#%%
+if __name__ == '__main__':
+    test_articles = get_articles_by_ids([
+        '0160459551e2d05d37d696dcbfedbe3165b7e6a0a649f97a2d643ea42a9066f4',
+        '086b01d02525187dfa7ba55891dfa3adaaf1ccedc7fb1c697c0563bdc04a0de5'
+        ])
 
 
 #%%
@@ -0,0 +1,382 @@
+# Offline builder of the per-user "For you" feed
+#
+# $python recommendation-builder.py --count 50
+# $python recommendation-builder.py --full
+#
+# Each run
+#   1. queries the days of the article metadata from a few days before the watermark of the
+#      last run up to today, and appends their new articles to a local feature store, hashed
+#      with the same features as the web tier's ranking (eb-flask/ranking.py). An article whose
+#      entities changed gets a new row replacing its old one. Past days crawled on demand by the
+#      web tier are older than the watermark, a --full run (e.g. weekly) scans the whole table for them
+#   2. scans the preference table and rebuilds every user profile from the rows of the labeled articles
+#   3. scores users whose labels changed against the whole corpus and the other users
+#      only against the new rows, merged into their previous top list
+#   4. writes the top lists that changed to the recommendation table, one item per user,
+#      so the web tier serves the feed with a single get_item
+#
+# Scoring is a dense (users x features) by (features x articles) matrix product over
+# blocks of the corpus, keeping a running top N per user.
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import boto3
+import numpy as np
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
+
+# config metadata
+region_name = 'us-east-1'
+article_dynamodb_table_name = 'ArticleMetadata'
+# the web tier reads and writes the user tables through its default session, see eb-flask/aws_gateway.py
+preference_region_name = 'us-west-1'
+preference_dynamodb_table_name = 'MyArticlePreferenceTable'
+recommendation_dynamodb_table_name = 'UserRecommendationTable'
+corpus_path = 'recommendation-corpus.npz'
+state_path = 'recommendation-state.json'
+recommendation_count = 50
+# articles per scoring block, a block is scored as one matrix product
+score_block_size = 512
+dynamo_read_workers = 8
+# the entity and sentiment index items share the article table, see article-retriever.py
+index_prefixes = ('ENTITY#', 'SENTIMENT#')
+# days before the watermark queried again, the analyzer adds the entities some time after the crawl
+# and the days around the last run may have been crawled again since
+reingest_days = 3
+article_projection = '#d, article_id, title, #u, entities'
+
+spec = importlib.util.spec_from_file_location(
+    'ranking', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'eb-flask', 'ranking.py'))
+ranking = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ranking)
+
+dynamo_client = boto3.client('dynamodb', region_name=region_name,
+                             config=Config(max_pool_connections=dynamo_read_workers))
+preference_table = boto3.resource('dynamodb', region_name=preference_region_name).Table(preference_dynamodb_table_name)
+recommendation_table = boto3.resource('dynamodb', region_name=preference_region_name).Table(recommendation_dynamodb_table_name)
+deserializer = TypeDeserializer()
+
+
+class ArticleCorpus:
+    '''
+    Append only store of the hashed article features, rows are never renumbered
+    so the top lists of the state file stay valid across runs.
+    An article appended again, after its entities changed, retires its previous row.
+    '''
+    def __init__(self, path=corpus_path):
+        self.path = path
+        if os.path.exists(path):
+            data = np.load(path)
+            self.matrix = ranking.FeatureMatrix.from_arrays(data['indices'], data['values'], data['offsets'])
+            # (date, article_id, title, url, entities key) per row
+            self.articles = [tuple(article) for article in json.loads(str(data['articles']))]
+            self.retired = data['retired']
+            # last day of the article table ingested, None if the corpus predates the watermark
+            self.watermark = (str(data['watermark']) or None) if 'watermark' in data.files else None
+        else:
+            self.matrix = ranking.FeatureMatrix()
+            self.articles = []
+            self.retired = np.zeros(0, dtype=bool)
+            self.watermark = None
+        self.rows = {article[1]: row for row, article in enumerate(self.articles) if not self.retired[row]}
+
+    def __len__(self):
+        return len(self.articles)
+
+    def is_current(self, article):
+        '''
+        @return - True if the article has a live row hashed with its current entities
+        '''
+        row = self.rows.get(article['article_id'])
+        return row is not None and self.articles[row][4] == get_entities_key(article)
+
+    def append(self, article_list):
+        '''
+        @param article_list - article dict with 'article_id', 'date', 'title', 'url' and 'entities'
+        '''
+        added = ranking.FeatureMatrix(article_list)
+        matrix = self.matrix
+        self.matrix = ranking.FeatureMatrix.from_arrays(
+            np.concatenate([matrix.indices, added.indices]),
+            np.concatenate([matrix.values, added.values]),
+            np.concatenate([matrix.offsets, added.offsets[1:] + matrix.offsets[-1]]))
+        self.retired = np.concatenate([self.retired, np.zeros(len(article_list), dtype=bool)])
+        for article in article_list:
+            if article['article_id'] in self.rows:
+                self.retired[self.rows[article['article_id']]] = True
+            self.rows[article['article_id']] = len(self.articles)
+            self.articles.append((article['date'], article['article_id'], article['title'], article['url'],
+                                  get_entities_key(article)))
+
+    def add_row_to(self, vector, row, weight):
+        '''
+        vector += weight * row, in place
+        '''
+        begin, end = self.matrix.offsets[row], self.matrix.offsets[row + 1]
+        np.add.at(vector, self.matrix.indices[begin:end], weight * self.matrix.values[begin:end])
+
+    def save(self):
+        # written aside and renamed, an interrupted run leaves the previous corpus intact
+        temp_path = self.path + '.tmp.npz'
+        np.savez(temp_path, indices=self.matrix.indices, values=self.matrix.values, offsets=self.matrix.offsets,
+                 articles=json.dumps(self.articles), retired=self.retired, watermark=self.watermark or '')
+        os.replace(temp_path, self.path)
+
+
+class RecommendationState:
+    '''
+    Per user hash of the labels and top list of the last run,
+    and the number of corpus rows every user was scored against
+    '''
+    def __init__(self, path=state_path):
+        self.path = path
+        self.scored_rows = 0
+        self.users = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+            self.scored_rows = state['scored_rows']
+            self.users = state['users']
+
+    def get_top(self, user_id):
+        '''
+        @return - (rows, scores) of the user's previous top list
+        '''
+        top = self.users.get(user_id, {}).get('top', [])
+        return [row for row, _ in top], [score for _, score in top]
+
+    def is_changed(self, user_id, labels_hash):
+        return self.users.get(user_id, {}).get('labels') != labels_hash
+
+    def set_user(self, user_id, labels_hash, rows, scores):
+        self.users[user_id] = {'labels': labels_hash, 'top': [[int(row), float(score)] for row, score in zip(rows, scores)]}
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'scored_rows': self.scored_rows, 'users': self.users}, f)
+        os.replace(temp_path, self.path)
+
+
+def get_entities_key(article):
+    return '|'.join(sorted(article.get('entities') or []))
+
+def to_article(item):
+    article = {key: deserializer.deserialize(value) for key, value in item.items()}
+    article['entities'] = list(article.get('entities') or [])
+    return article
+
+def query_date(date):
+    '''
+    @param date - date string of format yyyy/mm/dd
+    @return - list of article dict of the date
+    '''
+    paginator = dynamo_client.get_paginator('query')
+    article_list = []
+    for page in paginator.paginate(
+            TableName=article_dynamodb_table_name,
+            KeyConditionExpression='#d = :date',
+            ProjectionExpression=article_projection,
+            ExpressionAttributeNames={'#d': 'date', '#u': 'url'},
+            ExpressionAttributeValues={':date': {'S': date}}):
+        article_list += [to_article(item) for item in page['Items']]
+    return article_list
+
+def scan_segment(segment):
+    '''
+    @param segment - segment of the parallel scan of the article table
+    @return - list of article dict of the segment, without the index items
+    '''
+    paginator = dynamo_client.get_paginator('scan')
+    article_list = []
+    for page in paginator.paginate(
+            TableName=article_dynamodb_table_name,
+            Segment=segment,
+            TotalSegments=dynamo_read_workers,
+            ProjectionExpression=article_projection,
+            FilterExpression='NOT begins_with(#d, :entity) AND NOT begins_with(#d, :sentiment)',
+            ExpressionAttributeNames={'#d': 'date', '#u': 'url'},
+            ExpressionAttributeValues={':entity': {'S': index_prefixes[0]}, ':sentiment': {'S': index_prefixes[1]}}):
+        article_list += [to_article(item) for item in page['Items']]
+    return article_list
+
+def update_corpus(corpus, full=False):
+    '''
+    Append the stored articles missing from the corpus or whose entities changed since they were added.
+    Only the days from reingest_days before the watermark up to today are queried, unless full is set
+    or the corpus has no watermark, then the whole article table is scanned.
+    '''
+    today = datetime.utcnow()
+    with ThreadPoolExecutor(max_workers=dynamo_read_workers) as executor:
+        if full or corpus.watermark is None:
+            segments = executor.map(scan_segment, range(dynamo_read_workers))
+        else:
+            start = datetime.strptime(corpus.watermark, '%Y/%m/%d') - timedelta(days=reingest_days)
+            dates = [(start + timedelta(days=i)).strftime('%Y/%m/%d') for i in range((today - start).days + 1)]
+            print("querying {} days from {}".format(len(dates), dates[0] if dates else corpus.watermark))
+            segments = executor.map(query_date, dates)
+        article_list = [article for segment_articles in segments for article in segment_articles]
+    corpus.watermark = today.strftime('%Y/%m/%d')
+    changed = [article for article in article_list if not corpus.is_current(article)]
+    changed.sort(key=lambda article: (article['date'], article['article_id']))
+    replaced = sum(1 for article in changed if article['article_id'] in corpus.rows)
+    corpus.append(changed)
+    print("{} articles read, {} added to the corpus and {} replaced, {} rows in total".format(
+        len(article_list), len(changed) - replaced, replaced, len(corpus)))
+
+def scan_preferences():
+    '''
+    @return - {user_id: list of preference item}
+    '''
+    kwargs = {
+        'ProjectionExpression': 'user_id, article_id, title, #d, entities, preference',
+        'ExpressionAttributeNames': {'#d': 'date'}}
+    preferences = {}
+    while True:
+        response = preference_table.scan(**kwargs)
+        for item in response['Items']:
+            preferences.setdefault(item['user_id'], []).append(item)
+        if 'LastEvaluatedKey' not in response:
+            return preferences
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def get_labels_hash(items, corpus):
+    '''
+    Changes with the labels, and with the corpus rows of the labeled articles when their entities change
+    '''
+    labels = sorted((item['article_id'], item['preference'], corpus.rows.get(item['article_id'], -1)) for item in items)
+    return hashlib.sha256(json.dumps(labels).encode('utf-8')).hexdigest()
+
+def get_profile(items, corpus):
+    '''
+    @return - dense profile vector of the user, the weighted sum of the rows of the labeled articles,
+              like the web tier's UserProfile. Labeled articles missing from the corpus are hashed
+              from the preference item, which carries their entities
+    '''
+    vector = np.zeros(ranking.feature_dim, dtype=np.float32)
+    missing = {}
+    for item in items:
+        row = corpus.rows.get(item['article_id'])
+        if row is None:
+            missing.setdefault(item['preference'], []).append(item)
+        else:
+            corpus.add_row_to(vector, row, ranking.preference_weights.get(item['preference'], 0.0))
+    if len(missing) > 0:
+        vector += ranking.UserProfile(missing).vector
+    return vector
+
+def score_users(profiles, matrix, retired, start_row, labeled_users, labeled_rows, top_rows, top_scores, count):
+    '''
+    Running top count of profiles @ matrix rows from start_row on
+    @param profiles - (users, feature_dim) float32 array
+    @param retired - bool array of the rows left out for every user
+    @param labeled_users, labeled_rows - arrays of the (user, row) pairs left out
+    @param top_rows, top_scores - (users, count) arrays of the previous top lists, -1 and -inf for empty slots
+    @return - updated (top_rows, top_scores), each user's list sorted by decreasing score
+    '''
+    for block_start in range(start_row, len(matrix), score_block_size):
+        block_end = min(block_start + score_block_size, len(matrix))
+        scores = profiles @ matrix.to_dense(block_start, block_end).T
+        scores[:, retired[block_start:block_end]] = -np.inf
+        in_block = (labeled_rows >= block_start) & (labeled_rows < block_end)
+        scores[labeled_users[in_block], labeled_rows[in_block] - block_start] = -np.inf
+        rows = np.broadcast_to(np.arange(block_start, block_end), scores.shape)
+        candidate_rows = np.concatenate([top_rows, rows], axis=1)
+        candidate_scores = np.concatenate([top_scores, scores], axis=1)
+        keep = np.argpartition(-candidate_scores, count - 1, axis=1)[:, :count]
+        top_rows = np.take_along_axis(candidate_rows, keep, axis=1)
+        top_scores = np.take_along_axis(candidate_scores, keep, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(top_rows, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+def pad_top(rows, scores, count):
+    rows = list(rows)[:count]
+    scores = list(scores)[:count]
+    return rows + [-1] * (count - len(rows)), scores + [-np.inf] * (count - len(scores))
+
+def build_recommendations(corpus, state, preferences, count, rebuild=False):
+    '''
+    Users are scored against the rows added since state.scored_rows, or the whole corpus if their labels changed
+    @return - {user_id: (rows, scores)} of the users whose top list changed
+    '''
+    first_new_row = state.scored_rows
+    changed_users = []
+    new_article_users = []
+    for user_id, items in preferences.items():
+        if rebuild or state.is_changed(user_id, get_labels_hash(items, corpus)):
+            changed_users.append(user_id)
+        elif first_new_row < len(corpus):
+            new_article_users.append(user_id)
+    print("{} users with changed labels, {} users scored on {} new articles".format(
+        len(changed_users), len(new_article_users), len(corpus) - first_new_row))
+
+    updated = {}
+    for user_ids, start_row in ((changed_users, 0), (new_article_users, first_new_row)):
+        if len(user_ids) == 0:
+            continue
+        start_time = time.time()
+        profiles = np.stack([get_profile(preferences[user_id], corpus) for user_id in user_ids])
+        labeled = [(user, corpus.rows[item['article_id']]) for user, user_id in enumerate(user_ids)
+                   for item in preferences[user_id] if item['article_id'] in corpus.rows]
+        labeled_users = np.array([user for user, _ in labeled], dtype=np.int64)
+        labeled_rows = np.array([row for _, row in labeled], dtype=np.int64)
+        if start_row == 0:
+            top_rows = np.full((len(user_ids), count), -1, dtype=np.int64)
+            top_scores = np.full((len(user_ids), count), -np.inf, dtype=np.float32)
+        else:
+            tops = [pad_top(*state.get_top(user_id), count) for user_id in user_ids]
+            top_rows = np.array([rows for rows, _ in tops], dtype=np.int64)
+            top_scores = np.array([scores for _, scores in tops], dtype=np.float32)
+            # rows replaced since the last run are scored again as new rows
+            top_scores[(top_rows >= 0) & corpus.retired[top_rows]] = -np.inf
+        top_rows, top_scores = score_users(
+            profiles, corpus.matrix, corpus.retired, start_row, labeled_users, labeled_rows, top_rows, top_scores, count)
+        for user_id, rows, scores in zip(user_ids, top_rows, top_scores):
+            # only articles sharing features with what the user liked are recommended
+            keep = scores > 0
+            rows, scores = rows[keep], scores[keep]
+            if start_row == 0 or list(rows) != state.get_top(user_id)[0]:
+                updated[user_id] = (rows, scores)
+            state.set_user(user_id, get_labels_hash(preferences[user_id], corpus), rows, scores)
+        print("scored {} users on {} articles in {:.2f}s".format(len(user_ids), len(corpus) - start_row, time.time() - start_time))
+    state.scored_rows = len(corpus)
+    return updated
+
+def put_recommendations(corpus, updated):
+    built_at = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    with recommendation_table.batch_writer(overwrite_by_pkeys=['user_id']) as batch:
+        for user_id, (rows, scores) in updated.items():
+            articles = []
+            for row, score in zip(rows, scores):
+                date, article_id, title, url, _ = corpus.articles[row]
+                articles.append({'article_id': article_id, 'date': date, 'title': title, 'url': url,
+                                 'score': Decimal('{:.4f}'.format(score))})
+            batch.put_item(Item={'user_id': user_id, 'articles': articles, 'built_at': built_at})
+    print("{} recommendation lists written to {}".format(len(updated), recommendation_dynamodb_table_name))
+
+
+#%%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=recommendation_count, help='articles per user')
+    parser.add_argument('--rebuild', action='store_true', help='rescore every user against the whole corpus')
+    parser.add_argument('--full', action='store_true', help='scan the whole article table instead of the days since the last run')
+    args = parser.parse_args()
+
+    corpus = ArticleCorpus()
+    state = RecommendationState()
+    update_corpus(corpus, args.full)
+    corpus.save()
+    preferences = scan_preferences()
+    updated = build_recommendations(corpus, state, preferences, args.count, args.rebuild)
+    put_recommendations(corpus, updated)
+    # the state is saved last, the same users and articles are scored again if writing failed
+    state.save()